@@ -0,0 +1,192 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+# pylint: disable=import-outside-toplevel
+
+import os
+import json
+import hashlib
+import threading
+from time import time
+from contextlib import contextmanager
+
+from knack.log import get_logger
+from azure.cli.core._environment import get_config_dir
+
+from ._http_utils import get as http_get
+
+CACHE_DIR_NAME = 'lab-gateway'
+HTTP_CACHE_DIR_NAME = 'http'
+
+# how long a mutable response (i.e. latest release) is used before revalidating
+SHORT_TTL = 300
+
+logger = get_logger(__name__)
+
+_reads_lock = threading.Lock()
+
+
+class CachedResponse:  # pylint: disable=too-few-public-methods
+
+    def __init__(self, status_code, body=None, from_cache=False):
+        self.status_code = status_code
+        self.body = body
+        self.from_cache = from_cache
+
+    def json(self):
+        return self.body
+
+
+def get_cache_dir(*paths):
+    return os.path.join(get_config_dir(), CACHE_DIR_NAME, *paths)
+
+
+@contextmanager
+def file_lock(path):
+    """ Exclusive inter-process lock on a sidecar .lock file for path. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_json_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(path, value):
+    write_file(path, json.dumps(value).encode('utf-8'))
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def write_file(path, content):
+    """ Writes to a temp file then replaces path, so readers never see a partial file. """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        # the cache is best effort, a read-only config dir shouldn't fail the command
+        logger.debug('Unable to write cache file %s: %s', path, err)
+
+
+def get_json(url, ttl=SHORT_TTL, immutable=False):
+    """ GETs a json document through the on-disk http cache. Immutable responses are never
+    revalidated, others are reused for ttl seconds and then revalidated with a conditional
+    request. Only 200 responses with a valid json body are cached. """
+    path = get_cache_dir(HTTP_CACHE_DIR_NAME, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    with file_lock(path):
+        entry = read_json_file(path)
+
+    if entry and entry.get('url') != url:
+        entry = None
+
+    if entry and (entry.get('immutable') or time() - entry.get('fetched', 0) < ttl):
+        logger.debug('Using cached response for %s', url)
+        return CachedResponse(200, entry['body'], from_cache=True)
+
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('lastModified'):
+        headers['If-Modified-Since'] = entry['lastModified']
+
+    response = http_get(url, headers=headers)
+
+    if response.status_code == 304 and entry:
+        logger.debug('Cached response for %s is still valid', url)
+        entry['fetched'] = time()
+        with file_lock(path):
+            write_json_file(path, entry)
+        return CachedResponse(200, entry['body'], from_cache=True)
+
+    if response.status_code != 200:
+        return CachedResponse(response.status_code)
+
+    body = response.json()
+
+    entry = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'lastModified': response.headers.get('Last-Modified'),
+        'immutable': immutable,
+        'fetched': time(),
+        'body': body
+    }
+
+    with file_lock(path):
+        write_json_file(path, entry)
+
+    return CachedResponse(200, body)
+
+
+class _Read:  # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = False
+        self.value = None
+
+    def get(self, func, *args):
+        # concurrent callers of the same read wait for the first one instead of repeating it
+        with self.lock:
+            if not self.done:
+                self.value = func(*args)
+                self.done = True
+            return self.value
+
+
+def _get_reads(cli_ctx):
+    reads = getattr(cli_ctx, '_lab_gateway_reads', None)
+    if reads is None:
+        reads = {}
+        setattr(cli_ctx, '_lab_gateway_reads', reads)
+    return reads
+
+
+def cached_read(cli_ctx, key, func, *args):
+    """ Returns func(*args), memoized under the key tuple for the rest of the command invocation.
+    The cache lives on the cli_ctx, so it never outlives the command. Errors are not cached. """
+    with _reads_lock:
+        reads = _get_reads(cli_ctx)
+        read = reads.get(key)
+        if read is None:
+            read = reads[key] = _Read()
+    return read.get(func, *args)
+
+
+def invalidate_reads(cli_ctx, *key_prefix):
+    """ Drops the cached reads whose key starts with key_prefix, i.e. after writing the resource. """
+    with _reads_lock:
+        reads = _get_reads(cli_ctx)
+        for key in [k for k in reads if k[:len(key_prefix)] == key_prefix]:
+            del reads[key]
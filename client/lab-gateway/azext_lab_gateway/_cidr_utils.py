@@ -0,0 +1,206 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import ipaddress
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# ipv6 ranges are shifted past the end of the ipv4 space so both families
+# can live in one sorted list without ever being adjacent or overlapping
+IPV6_OFFSET = 1 << 129
+
+# below this many ranges the numpy conversion costs more than it saves
+NUMPY_MIN_RANGES = 1024
+
+
+def to_range(value, strict=False):
+    """ Converts an address, CIDR prefix, or ip_network to an inclusive (start, end) integer range. """
+    network = value if isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)) \
+        else ipaddress.ip_network(str(value).strip(), strict=strict)
+    offset = IPV6_OFFSET if network.version == 6 else 0
+    return int(network.network_address) + offset, int(network.broadcast_address) + offset
+
+
+def from_range(start, end):
+    """ Converts an inclusive (start, end) integer range to the minimal list of ip_networks covering it. """
+    if start >= IPV6_OFFSET:
+        first, last = ipaddress.IPv6Address(start - IPV6_OFFSET), ipaddress.IPv6Address(end - IPV6_OFFSET)
+    else:
+        first, last = ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)
+    return list(ipaddress.summarize_address_range(first, last))
+
+
+def merge_ranges(ranges):
+    """ Sorts ranges and merges overlapping and adjacent ones. """
+    ranges = list(ranges)
+    if numpy is not None and len(ranges) >= NUMPY_MIN_RANGES and all(r[1] < IPV6_OFFSET for r in ranges):
+        return _merge_ranges_numpy(ranges)
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def _merge_ranges_numpy(ranges):
+    # ipv4 ranges fit in int64, so the sort and sweep can be vectorized
+    bounds = numpy.array(ranges, dtype=numpy.int64)
+    bounds = bounds[numpy.lexsort((bounds[:, 1], bounds[:, 0]))]
+    starts, ends = bounds[:, 0], numpy.maximum.accumulate(bounds[:, 1])
+    # a range starts a new merged range when it begins after everything before it ends (+1 merges adjacent)
+    first = numpy.empty(len(starts), dtype=bool)
+    first[0] = True
+    first[1:] = starts[1:] > ends[:-1] + 1
+    last = numpy.append(numpy.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return list(zip(starts[first].tolist(), ends[last].tolist()))
+
+
+def aggregate_prefixes(prefixes):
+    """ Dedupes prefixes, drops those contained in others and merges adjacent ones,
+    returning the minimal list of CIDR prefixes covering the same addresses. """
+    return IPRangeSet(prefixes).to_prefixes()
+
+
+class IPRangeSet:
+    """ A set of ip addresses stored as sorted, disjoint, inclusive integer ranges.
+    Membership, containment and overlap checks are O(log n). """
+
+    def __init__(self, values=None, strict=False):
+        self._starts = []
+        self._ends = []
+        if values:
+            self._set_ranges(merge_ranges(to_range(v, strict=strict) for v in values))
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        range_set = cls()
+        range_set._set_ranges(merge_ranges(ranges))  # pylint: disable=protected-access
+        return range_set
+
+    def _set_ranges(self, ranges):
+        self._starts = [r[0] for r in ranges]
+        self._ends = [r[1] for r in ranges]
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+    def __eq__(self, other):
+        return isinstance(other, IPRangeSet) and self._starts == other._starts and self._ends == other._ends
+
+    def __contains__(self, value):
+        return self.contains(value)
+
+    def _index(self, start):
+        # index of the last range starting at or before start, or -1
+        return bisect_right(self._starts, start) - 1
+
+    def contains(self, value):
+        """ Whether every address in value (an address or prefix) is in the set. """
+        start, end = to_range(value)
+        i = self._index(start)
+        return i >= 0 and self._ends[i] >= end
+
+    def overlaps(self, value):
+        """ Whether any address in value (an address or prefix) is in the set. """
+        start, end = to_range(value)
+        i = self._index(end)
+        return i >= 0 and self._ends[i] >= start
+
+    def add(self, value):
+        self._set_ranges(merge_ranges(list(self) + [to_range(value)]))
+
+    def discard(self, value):
+        self._set_ranges(list(self.subtract([value])))
+
+    def first_fit(self, prefix_length, version=4):
+        """ Returns the lowest aligned /prefix_length network entirely inside the set, or None. """
+        offset = IPV6_OFFSET if version == 6 else 0
+        size = 1 << ((32 if version == 4 else 128) - prefix_length)
+        for start, end in self:
+            if (start >= IPV6_OFFSET) != (version == 6):
+                continue
+            # round up to the next block boundary
+            aligned = offset + -(-(start - offset) // size) * size
+            if aligned + size - 1 <= end:
+                return from_range(aligned, aligned + size - 1)[0]
+        return None
+
+    def union(self, other):
+        return IPRangeSet.from_ranges(list(self) + list(other))
+
+    def subtract(self, other):
+        """ Returns the addresses in this set that are not in other. """
+        other = other if isinstance(other, IPRangeSet) else IPRangeSet(other)
+        result = []
+        for start, end in self:
+            # only the ranges in other that can intersect this one need to be visited
+            i = max(other._index(start), 0)  # pylint: disable=protected-access
+            while start <= end and i < len(other):
+                o_start, o_end = other._starts[i], other._ends[i]  # pylint: disable=protected-access
+                if o_start > end:
+                    break
+                if o_end >= start:
+                    if o_start > start:
+                        result.append((start, o_start - 1))
+                    start = o_end + 1
+                i += 1
+            if start <= end:
+                result.append((start, end))
+        return IPRangeSet.from_ranges(result)
+
+    def to_networks(self):
+        """ Returns the minimal list of ip_networks that cover the set. """
+        return [n for start, end in self for n in from_range(start, end)]
+
+    def to_prefixes(self):
+        return [str(n) for n in self.to_networks()]
+
+
+class IPPrefixIndex:
+    """ Maps addresses to the labelled prefix that contains them. Prefixes contained in another
+    are dropped (CIDR prefixes either nest or are disjoint), so the rest are disjoint and sorted,
+    and each lookup is a binary search. """
+
+    def __init__(self, items):
+        entries = sorted(((*to_range(prefix), prefix, label) for prefix, label in items),
+                         key=lambda e: (e[0], -e[1]))
+        kept = []
+        for entry in entries:
+            if not kept or entry[0] > kept[-1][1]:
+                kept.append(entry)
+        self._starts = [e[0] for e in kept]
+        self._ends = [e[1] for e in kept]
+        self._items = [(e[2], e[3]) for e in kept]
+
+    def __len__(self):
+        return len(self._starts)
+
+    def lookup(self, address):
+        """ Returns the (prefix, label) containing address, or None. """
+        return self.lookup_many([address])[0]
+
+    def lookup_many(self, addresses):
+        """ Returns the (prefix, label) containing each address, or None, in order. """
+        points = [to_range(a)[0] for a in addresses]
+        if numpy is not None and len(points) >= NUMPY_MIN_RANGES and self._ends and self._ends[-1] < IPV6_OFFSET \
+                and all(p < IPV6_OFFSET for p in points):
+            indexes = (numpy.searchsorted(numpy.array(self._starts, dtype=numpy.int64),
+                                          numpy.array(points, dtype=numpy.int64), side='right') - 1).tolist()
+        else:
+            indexes = [bisect_right(self._starts, p) - 1 for p in points]
+        return [self._items[i] if i >= 0 and self._ends[i] >= p else None for i, p in zip(indexes, points)]
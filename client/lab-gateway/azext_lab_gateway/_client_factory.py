@@ -4,51 +4,124 @@
 # --------------------------------------------------------------------------------------------
 # pylint: disable=import-outside-toplevel
 
+import threading
+from time import time
+from datetime import datetime
+
 from azure.cli.core.commands.client_factory import get_mgmt_service_client
 from azure.cli.core.profiles import get_api_version, ResourceType
 
+from ._http_utils import get_session
+from ._cache_utils import cached_read
+
+# tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+# how long a token is reused when its expiry can't be read
+TOKEN_DEFAULT_TTL = 300
+
+
+def _get_transport(cli_ctx):
+    """ One transport per command, on the shared keep-alive session, so every management
+    client reuses the same pooled connections. """
+    from azure.core.pipeline.transport import RequestsTransport
+    return cached_read(cli_ctx, ('transport',), lambda: RequestsTransport(session=get_session(),
+                                                                           session_owner=False))
+
+
+def _create_client(cli_ctx, client_type):
+    if isinstance(client_type, ResourceType):
+        return get_mgmt_service_client(cli_ctx, client_type, transport=_get_transport(cli_ctx))
+    return get_mgmt_service_client(cli_ctx, client_type)
+
+
+def get_client(cli_ctx, client_type):
+    """ Returns the management client for client_type, created once per command. """
+    return cached_read(cli_ctx, ('client', client_type), _create_client, cli_ctx, client_type)
+
 
 def storage_client_factory(cli_ctx, **_):
-    return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_STORAGE)
+    return get_client(cli_ctx, ResourceType.MGMT_STORAGE)
 
 
 def web_client_factory(cli_ctx, **_):
-    return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_APPSERVICE)
+    return get_client(cli_ctx, ResourceType.MGMT_APPSERVICE)
 
 
 def resource_client_factory(cli_ctx, **_):
-    return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_RESOURCE_RESOURCES)
+    return get_client(cli_ctx, ResourceType.MGMT_RESOURCE_RESOURCES)
 
 
 def cosmosdb_client_factory(cli_ctx, **_):
     from azure.mgmt.cosmosdb import CosmosDBManagementClient
-    return get_mgmt_service_client(cli_ctx, CosmosDBManagementClient)
+    return get_client(cli_ctx, CosmosDBManagementClient)
 
 
 def appconfig_client_factory(cli_ctx, **_):
     from azure.mgmt.appconfiguration import AppConfigurationManagementClient
-    return get_mgmt_service_client(cli_ctx, AppConfigurationManagementClient)
+    return get_client(cli_ctx, AppConfigurationManagementClient)
 
 
 def network_client_factory(cli_ctx, **_):
-    return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_NETWORK)
+    return get_client(cli_ctx, ResourceType.MGMT_NETWORK)
 
 
 def keyvault_client_factory(cli_ctx, **_):
-    return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_KEYVAULT)
+    return get_client(cli_ctx, ResourceType.MGMT_KEYVAULT)
 
 
 def labs_client_factory(cli_ctx, **_):
     from azure.mgmt.devtestlabs import DevTestLabsClient
-    return get_mgmt_service_client(cli_ctx, DevTestLabsClient)
+    return get_client(cli_ctx, DevTestLabsClient)
 
 
 def keyvault_data_client_factory(cli_ctx, **_):
-    from azure.cli.core._profile import Profile
-    version = str(get_api_version(cli_ctx, ResourceType.DATA_KEYVAULT))
+    """ Returns the Key Vault data plane client, created once per command. The client isn't bound
+    to a vault, and the auth challenge for each vault is cached by url, so one client serves all of them. """
+    return cached_read(cli_ctx, ('keyvault_data',), _create_keyvault_data_client, cli_ctx)
 
-    def get_token(server, resource, scope):  # pylint: disable=unused-argument
-        return Profile(cli_ctx=cli_ctx).get_raw_token(resource)[0]
+
+def _create_keyvault_data_client(cli_ctx):
+    version = str(get_api_version(cli_ctx, ResourceType.DATA_KEYVAULT))
+    get_token = KeyVaultTokenCache(cli_ctx).get_token
 
     from azure.keyvault import KeyVaultAuthentication, KeyVaultClient
     return KeyVaultClient(KeyVaultAuthentication(get_token), api_version=version)
+
+
+class KeyVaultTokenCache:
+    """ Keeps the raw token for each resource until shortly before it expires, instead of
+    acquiring a new one every time Key Vault challenges for auth. """
+
+    def __init__(self, cli_ctx):
+        from azure.cli.core._profile import Profile
+        self._profile = Profile(cli_ctx=cli_ctx)
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, server, resource, scope):  # pylint: disable=unused-argument
+        with self._lock:
+            token, expires_on = self._tokens.get(resource, (None, 0))
+            if token is None or time() > expires_on - TOKEN_REFRESH_MARGIN:
+                token = self._profile.get_raw_token(resource)[0]
+                expires_on = _get_token_expiry(token)
+                self._tokens[resource] = (token, expires_on)
+            return token
+
+
+def _get_token_expiry(token):
+    entry = token[2] if len(token) > 2 and isinstance(token[2], dict) else {}
+    expires_on = entry.get('expires_on')
+    if expires_on is not None:
+        try:
+            return float(expires_on)
+        except (TypeError, ValueError):
+            pass
+    expires_on = entry.get('expiresOn')
+    if expires_on:
+        try:
+            # adal style local time, i.e. 2021-06-01 12:00:00.000000
+            return datetime.strptime(expires_on, '%Y-%m-%d %H:%M:%S.%f').timestamp()
+        except (TypeError, ValueError):
+            pass
+    # unknown format, only reuse the token for a short while
+    return time() + TOKEN_REFRESH_MARGIN + TOKEN_DEFAULT_TTL
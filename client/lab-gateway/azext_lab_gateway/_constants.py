@@ -4,11 +4,44 @@
 # --------------------------------------------------------------------------------------------
 
 TAG_PREFIX = 'hidden-lgw:'
+# each location added by lab connect has its own tag, hidden-lgw:location:{name}
+LOCATION_TAG_PREFIX = 'location:'
+
+AUTO_PREFIX = 'auto'
+
+# size of the subnets allocated when a subnet address prefix is 'auto'
+AUTO_SUBNET_PREFIX_LENGTHS = {
+    'rdgateway': 24,
+    'appgateway': 26,
+    'bastion': 27
+}
 
 API_WAF_RULE_NAME = 'AllowAzureCloudIPs'
+API_WAF_RULE_PRIORITY = 10
 GATEWAY_WAF_RULE_NAME = 'AllowKnownIPs'
+GATEWAY_WAF_RULE_PRIORITY = 8
+
+# application gateway waf service limits
+WAF_MAX_CUSTOM_RULES = 100
+WAF_MAX_MATCH_VALUES_PER_CONDITION = 540
+WAF_MAX_MATCH_VALUES_PER_RULE = 600
+# azure resource manager limits
+RESOURCE_GROUP_MAX_TAGS = 50
 # GATEWAY_WAF_RULE_NAME = 'BlockUnknownUris'
 
+# templates deployB is split into, by the name used with --stage
+DEPLOY_STAGES = {
+    'core': 'deployBCore',
+    'network': 'deployBNetwork',
+    'function': 'deployBFunction',
+    'bastion': 'deployBBastion',
+    'gateway': 'deployBGateway',
+    'vmss': 'deployBVmss'
+}
+
+# deployments whose fingerprint is recorded in a hidden-lgw:{name} tag, these aren't gateway properties
+FINGERPRINT_TAG_NAMES = ('deployA', 'deployB') + tuple(DEPLOY_STAGES.values())
+
 LAB_REGIONS_CANARY = ['westcentralus']
 LAB_REGIONS_LOW_VOL = ['southcentralus']
 LAB_REGIONS_HIGH_VOL = ['centralus']
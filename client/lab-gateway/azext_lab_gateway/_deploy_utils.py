@@ -4,67 +4,279 @@
 # --------------------------------------------------------------------------------------------
 # pylint: disable=too-many-statements, too-many-locals
 
+import re
 import json
-from time import sleep
+import hashlib
+import threading
+from time import (time, sleep, monotonic)
+from urllib.parse import urlparse
 from knack.log import get_logger
 from knack.util import CLIError
 from msrestazure.tools import resource_id, parse_resource_id
-from azure.cli.core.commands import LongRunningOperation, upsert_to_collection
-from azure.cli.core.commands.client_factory import get_subscription_id
 from azure.cli.core.profiles import ResourceType, get_sdk
-from azure.cli.core.util import (random_string, sdk_no_wait, find_child_item)
-from azure.cli.core.azclierror import ResourceNotFoundError
-
+from azure.cli.core.util import (random_string, sdk_no_wait)
+from azure.core.exceptions import HttpResponseError
+from azure.cli.core.azclierror import (ResourceNotFoundError, AzureResponseError)
+
+from ._http_utils import (retry_call, get_retry_after, RETRY_STATUS_CODES)
+from ._cache_utils import (get_cache_dir, file_lock, read_json_file, write_json_file, cached_read,
+                           invalidate_reads)
+from ._utils import (get_tag, get_tag_locations, get_subscription_id)
+from ._cidr_utils import (IPRangeSet, IPPrefixIndex, aggregate_prefixes)
+from ._template_utils import get_template_parameters
 from ._client_factory import (resource_client_factory, web_client_factory, network_client_factory)
-from ._constants import (API_WAF_RULE_NAME, GATEWAY_WAF_RULE_NAME,
-                         get_service_tags, get_api_waf_name, get_gateway_waf_name)
+from ._constants import (tag_key, LOCATION_TAG_PREFIX, API_WAF_RULE_NAME, API_WAF_RULE_PRIORITY,
+                         GATEWAY_WAF_RULE_NAME, GATEWAY_WAF_RULE_PRIORITY, WAF_MAX_CUSTOM_RULES,
+                         WAF_MAX_MATCH_VALUES_PER_CONDITION, WAF_MAX_MATCH_VALUES_PER_RULE, get_service_tags,
+                         RESOURCE_GROUP_MAX_TAGS, get_api_waf_name, get_gateway_waf_name)
 # from ._utils import same_location
 
 TRIES = 3
+# a single deployment can run for tens of minutes, so only stop retrying after a couple hours
+DEPLOY_DEADLINE = 2 * 60 * 60
 
-logger = get_logger(__name__)
+# deployments are polled every 15 seconds while resources are changing, backing off to every
+# 60 seconds while they aren't. a poll that fails this many times in a row stops the watch
+OPERATIONS_POLL_INTERVAL_MIN = 15
+OPERATIONS_POLL_INTERVAL_MAX = 60
+OPERATIONS_POLL_BACKOFF = 1.5
+OPERATIONS_POLL_MAX_FAILURES = 10
+DEPLOYMENT_TERMINAL_STATES = ('Succeeded', 'Failed', 'Canceled')
+
+# how many times a conditional write is re-read, merged and retried after losing a race
+CONFLICT_TRIES = 5
 
-# pylint: disable=inconsistent-return-statements
+# parameters whose names contain these are hashed before being fingerprinted
+SECRET_PARAMETER_NAMES = ('password', 'secret', 'token', 'key')
 
+SERVICE_TAGS_DIR_NAME = 'service-tags'
+SERVICE_TAG_PREFIX = 'AzureCloud.'
+# service tags are published weekly
+SERVICE_TAGS_TTL = 24 * 60 * 60
+
+logger = get_logger(__name__)
 
-def deploy_arm_template_at_resource_group(cmd, resource_group_name=None, template_file=None,
-                                          template_uri=None, parameters=None, no_wait=False):
+_service_tags = {}
+_service_tags_lock = threading.Lock()
 
-    from azure.cli.command_modules.resource.custom import _prepare_deployment_properties_unmodified   # pylint: disable=import-outside-toplevel
 
-    properties = _prepare_deployment_properties_unmodified(cmd, 'resourceGroup', template_file=template_file,
-                                                           template_uri=template_uri, parameters=parameters,
-                                                           mode='Incremental')
+def deploy_arm_template_at_resource_group(cmd, resource_group_name=None, template=None, parameters=None,
+                                          no_wait=False, progress=None, template_name='template'):
+    """ Deploys the template content inline, so arm never has to fetch it. The parameters are
+    checked against the template's parameter schema before the deployment is sent. """
+    DeploymentProperties = cmd.get_models('DeploymentProperties', resource_type=ResourceType.MGMT_RESOURCE_RESOURCES)
+    properties = DeploymentProperties(template=template, mode='Incremental',
+                                      parameters=get_template_parameters(template, parameters, template_name))
 
     client = resource_client_factory(cmd.cli_ctx).deployments
 
-    for try_number in range(TRIES):
+    def _deploy():
+        deployment_name = random_string(length=15, force_lower=True)
+
+        Deployment = cmd.get_models('Deployment', resource_type=ResourceType.MGMT_RESOURCE_RESOURCES)
+        deployment = Deployment(properties=properties)
+
+        # started without polling, watch_deployment is the only poll loop
+        result = sdk_no_wait(True, client.begin_create_or_update, resource_group_name,
+                             deployment_name, deployment).result()
+
+        if not no_wait:
+            result = watch_deployment(cmd, resource_group_name, deployment_name, progress=progress)
+
+        props = getattr(result, 'properties', None)
+        return result, getattr(props, 'outputs', None)
+
+    host = urlparse(cmd.cli_ctx.cloud.endpoints.resource_manager).netloc
+
+    return retry_call(_deploy, _is_service_unavailable, host=host, tries=TRIES, deadline=DEPLOY_DEADLINE)
+
+
+def wait_for_poller(poller):
+    """ Waits for an LRO poller, raising the same errors as LongRunningOperation. LongRunningOperation
+    drives the cli's progress controller, which isn't thread safe, and ending it would end the progress
+    display of the whole command, so it can't be used in task graph steps. """
+    try:
+        return poller.result()
+    except Exception as err:  # pylint: disable=broad-except
+        from azure.cli.core.commands.arm import (  # pylint: disable=import-outside-toplevel
+            handle_long_running_operation_exception)
+        handle_long_running_operation_exception(err)
+        raise
+
+
+def _report(progress, message):
+    if progress:
+        progress(message)
+    else:
+        logger.info(message)
+
+
+def watch_deployment(cmd, resource_group_name, deployment_name, progress=None, deadline=DEPLOY_DEADLINE):
+    """ Polls the deployment until it finishes, listing its operations on each poll, and reports each resource
+    whose state changed since the last poll to progress(message). This is the only poll loop, the deployment is
+    started without a poller. The deployment itself is only read when none of its operations are running or
+    nothing changed, it can't finish while they're making progress. The wait between polls grows while nothing
+    changes and resets when something does, and a throttled poll waits for its Retry-After. Gives up after
+    OPERATIONS_POLL_MAX_FAILURES failed polls in a row or deadline seconds. Logs the slowest resources and
+    returns the deployment once it succeeds, raises DeploymentFailedError if it doesn't. """
+    client = resource_client_factory(cmd.cli_ctx)
+
+    states, durations = {}, {}
+    interval = OPERATIONS_POLL_INTERVAL_MIN
+    start = monotonic()
+    failures = 0
+
+    while True:
+        if monotonic() - start + interval > deadline:
+            raise AzureResponseError(f'Timed out after {deadline} seconds waiting for deployment {deployment_name} '
+                                     'to finish. It may still be running, check its status in the Azure portal')
+        sleep(interval)
+
         try:
-            deployment_name = random_string(length=14, force_lower=True) + str(try_number)
-
-            Deployment = cmd.get_models('Deployment', resource_type=ResourceType.MGMT_RESOURCE_RESOURCES)
-            deployment = Deployment(properties=properties)
-
-            deploy_poll = sdk_no_wait(no_wait, client.begin_create_or_update, resource_group_name,
-                                      deployment_name, deployment)
-
-            result = LongRunningOperation(cmd.cli_ctx, start_msg='Deploying ARM template',
-                                          finish_msg='Finished deploying ARM template')(deploy_poll)
-
-            props = getattr(result, 'properties', None)
-            return result, getattr(props, 'outputs', None)
-        except CLIError as err:
-            if try_number == TRIES - 1:
-                raise err
-            try:
-                response = getattr(err, 'response', None)
-                message = json.loads(response.text)['error']['details'][0]['message']
-                if '(ServiceUnavailable)' not in message:
-                    raise err
-            except:
-                raise err from err
-            sleep(5)
+            operations = list(client.deployment_operations.list(resource_group_name, deployment_name))
+            changed = _report_operations(operations, states, durations, progress)
+            running = any(o.properties is not None and o.properties.provisioning_state not in
+                          DEPLOYMENT_TERMINAL_STATES for o in operations)
+            deployment = client.deployments.get(resource_group_name, deployment_name) \
+                if not running or not changed else None
+        except HttpResponseError as err:
+            failures += 1
+            if err.status_code not in RETRY_STATUS_CODES or failures >= OPERATIONS_POLL_MAX_FAILURES:
+                raise
+            retry_after = get_retry_after(getattr(err, 'response', None))
+            interval = max(retry_after if retry_after is not None else OPERATIONS_POLL_INTERVAL_MAX,
+                           OPERATIONS_POLL_INTERVAL_MIN)
+            logger.debug('Unable to read deployment %s: %s', deployment_name, err)
             continue
+        failures = 0
+
+        state = deployment.properties.provisioning_state if deployment is not None else None
+        if state in DEPLOYMENT_TERMINAL_STATES:
+            break
+
+        interval = OPERATIONS_POLL_INTERVAL_MIN if changed \
+            else min(interval * OPERATIONS_POLL_BACKOFF, OPERATIONS_POLL_INTERVAL_MAX)
+
+    for name, duration in sorted(durations.items(), key=lambda d: d[1], reverse=True)[:5]:
+        logger.info('%s took %.0f seconds', name, duration)
+
+    if state != 'Succeeded':
+        raise DeploymentFailedError(deployment_name, state, deployment.properties.error)
+
+    return deployment
+
+
+def _report_operations(operations, states, durations, progress):
+    """ Reports the operations whose state changed since they were last seen, returns whether any did. """
+    changed = False
+    for operation in operations:
+        props = operation.properties
+        target = getattr(props, 'target_resource', None)
+        if props is None or target is None or not target.resource_name:
+            continue
+        if states.get(operation.operation_id) == props.provisioning_state:
+            continue
+        states[operation.operation_id] = props.provisioning_state
+        changed = True
+
+        name = f'{target.resource_type.split("/")[-1]} {target.resource_name}'
+        duration = _parse_duration(props.duration)
+        message = f'{name}: {props.provisioning_state}'
+        if props.provisioning_state in ('Succeeded', 'Failed') and duration is not None:
+            durations[name] = duration
+            message += f' ({duration:.0f}s)'
+        _report(progress, message)
+    return changed
+
+
+class DeploymentFailedError(AzureResponseError):
+
+    def __init__(self, deployment_name, state, error=None):
+        self.error = error
+        message = f'Deployment {deployment_name} {state.lower()}'
+        if error is not None:
+            message += f': ({error.code}) {error.message}'
+            for detail in error.details or []:
+                message += f'\n  ({detail.code}) {detail.message}'
+        super().__init__(message)
+
+
+def _parse_duration(duration):
+    """ Converts an ISO 8601 duration (i.e. PT1M30.5S) to seconds. """
+    parts = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?', duration or '')
+    if not parts:
+        return None
+    days, hours, minutes, seconds = (float(p or 0) for p in parts.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def _is_service_unavailable(err):
+    if not isinstance(err, DeploymentFailedError) or err.error is None:
+        return False
+    return any(d.code == 'ServiceUnavailable' or '(ServiceUnavailable)' in (d.message or '')
+               for d in err.error.details or [])
+
+
+def get_deployment_fingerprint(template, parameters, extra=None):
+    """ Returns a sha256 over the template content, the resolved parameters and any extra inputs
+    the deployment depends on (i.e. artifact hashes). Secret parameter values are hashed before
+    they're added, so they're never recoverable. """
+    resolved = {}
+    for param in (p for params in parameters or [] for p in params):
+        name, _, value = param.partition('=')
+        if any(s in name.lower() for s in SECRET_PARAMETER_NAMES):
+            value = hashlib.sha256(value.encode('utf-8')).hexdigest()
+        resolved[name] = value
+
+    fingerprint = {'template': template, 'parameters': resolved, 'extra': extra}
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def deploy_arm_template_if_changed(cmd, resource_group_name, name, template, parameters=None, extra=None,
+                                   force=False, progress=None):
+    """ Deploys the template unless the last successful deployment of it, recorded in the resource group's
+    name tag, had the same fingerprint. Then the previous deployment's outputs are returned instead. """
+    # fail on bad parameters before reading anything from arm
+    get_template_parameters(template, parameters, name)
+
+    fingerprint = get_deployment_fingerprint(template, parameters, extra)
+
+    previous = get_tag(get_resource_group_tags(cmd, resource_group_name), name)
+    if previous and not force:
+        deployment_name, _, previous_fingerprint = previous.partition(':')
+        if previous_fingerprint == fingerprint:
+            deployment = get_succeeded_deployment(cmd, resource_group_name, deployment_name)
+            if deployment is not None:
+                logger.warning('Skipping %s, the template and parameters are unchanged since deployment %s',
+                               name, deployment_name)
+                return deployment, deployment.properties.outputs
+
+    result, outputs = deploy_arm_template_at_resource_group(cmd, resource_group_name, template=template,
+                                                            parameters=parameters, progress=progress,
+                                                            template_name=name)
+
+    tag_resource_group(cmd, resource_group_name, {tag_key(name): f'{result.name}:{fingerprint}'})
+
+    return result, outputs
+
+
+def get_recorded_deployment(cmd, resource_group_name, name):
+    """ Returns the last successful deployment recorded in the resource group's name tag, or None. """
+    previous = get_tag(get_resource_group_tags(cmd, resource_group_name), name)
+    if not previous:
+        return None
+    return get_succeeded_deployment(cmd, resource_group_name, previous.partition(':')[0])
+
+
+def get_succeeded_deployment(cmd, resource_group_name, deployment_name):
+    """ Returns the deployment if it still exists and succeeded, otherwise None. """
+    client = resource_client_factory(cmd.cli_ctx).deployments
+    try:
+        deployment = client.get(resource_group_name, deployment_name)
+    except HttpResponseError:
+        return None
+    props = getattr(deployment, 'properties', None)
+    return deployment if props is not None and props.provisioning_state == 'Succeeded' else None
 
 
 def get_arm_output(outputs, key, raise_on_error=True):
@@ -80,6 +292,12 @@ def get_arm_output(outputs, key, raise_on_error=True):
 
 
 def get_function_key(cmd, resource_group_name, function_app_name, function_name, key_name):
+    key = ('function_key', resource_group_name.lower(), function_app_name.lower(), function_name, key_name)
+    return cached_read(cmd.cli_ctx, key, _get_function_key, cmd, resource_group_name, function_app_name,
+                       function_name, key_name)
+
+
+def _get_function_key(cmd, resource_group_name, function_app_name, function_name, key_name):
     web_client = web_client_factory(cmd.cli_ctx).web_apps
 
     keys = web_client.list_function_keys(resource_group_name, function_app_name, function_name)
@@ -102,142 +320,271 @@ def get_function_key(cmd, resource_group_name, function_app_name, function_name,
         return new_key.value
 
 
+def get_service_tag_snapshot(cmd, location):
+    """ Returns {tag id: address prefixes} for the AzureCloud.* service tags of the current cloud.
+
+    The full service tag list is several MB, so only the tags we need are kept, on disk keyed by cloud
+    and change number. The snapshot is revalidated after SERVICE_TAGS_TTL and shared by every caller
+    in the process. """
+    cloud = cmd.cli_ctx.cloud.name
+
+    with _service_tags_lock:
+        snapshot = _service_tags.get(cloud)
+        if snapshot is not None:
+            return snapshot['tags']
+
+        path = get_cache_dir(SERVICE_TAGS_DIR_NAME, f'{cloud.lower()}.json')
+
+        with file_lock(path):
+            snapshot = read_json_file(path)
+
+        if not snapshot or time() - snapshot.get('fetched', 0) >= SERVICE_TAGS_TTL:
+            client = network_client_factory(cmd.cli_ctx).service_tags
+            service_tags = client.list(location)
+
+            if snapshot and snapshot.get('changeNumber') == service_tags.change_number:
+                logger.info('Service tags unchanged (change number %s)', service_tags.change_number)
+                snapshot['fetched'] = time()
+            else:
+                snapshot = {
+                    'cloud': cloud,
+                    'changeNumber': service_tags.change_number,
+                    'fetched': time(),
+                    'tags': {t.id: t.properties.address_prefixes for t in service_tags.values
+                             if t.id.startswith(SERVICE_TAG_PREFIX)}
+                }
+
+            del service_tags
+
+            with file_lock(path):
+                write_json_file(path, snapshot)
+
+        _service_tags[cloud] = snapshot
+        return snapshot['tags']
+
+
 def get_azure_rp_ips(cmd, location, locations=None):
 
-    client = network_client_factory(cmd.cli_ctx).service_tags
-    service_tags = client.list(location)
+    service_tags = get_service_tag_snapshot(cmd, location)
 
     if not locations:
         locations = [location]
 
     bcdrs = get_service_tags(locations)
 
-    ips = [t.properties.address_prefixes for t in service_tags.values if t.id in bcdrs]
-    # if bcdrs:
-    #     ips = [t.properties.address_prefixes for t in service_tags.values if t.id in bcdrs]
-    # else:
-    #     tag = next(t for t in service_tags.values if t.id == 'AzureCloud')
-    #     ips = tag.properties.address_prefixes
-    #     ips = [ips[i:i + 500] for i in range(0, len(ips), 500)]  # break down to lists of <= 500
+    ips = [service_tags[t] for t in bcdrs if t in service_tags]
 
     return ips
 
 
-def update_api_waf_policy(cmd, prefix, resource_group_name, locations):
+def aggregate_azure_rp_ips(ips):
+    """ Merges the address prefixes of all service tags into the minimal list of prefixes. The tags
+    overlap heavily and the WAF rule allows the union of its conditions, so nothing is lost. """
+    return aggregate_prefixes(prefix for tag_ips in ips for prefix in tag_ips)
 
-    policy_name = get_api_waf_name(prefix)
 
-    client = network_client_factory(cmd.cli_ctx).web_application_firewall_policies
+def pack_match_values(values, rule_name=None, per_condition=WAF_MAX_MATCH_VALUES_PER_CONDITION,
+                      per_rule=WAF_MAX_MATCH_VALUES_PER_RULE):
+    """ Splits match values into the fewest match conditions (lists of values) that fit in one
+    waf custom rule. Raises if they don't fit in one rule, an allow list can't be split across rules. """
+    values = list(values)
+    if len(values) > per_rule:
+        raise CLIError(f'The {rule_name or "ip"} allow list has {len(values)} prefixes after aggregation, '
+                       f'more than the {per_rule} a single waf custom rule can match')
+    if not values:
+        return [[]]
+    return [values[i:i + per_condition] for i in range(0, len(values), per_condition)]
+
+
+def _is_ip_rule(rule, rule_name):
+    if rule.name == rule_name:
+        return True
+    # earlier versions wrote the values that didn't fit into {rule_name}-{n} allow rules
+    name, _, number = rule.name.rpartition('-')
+    return name == rule_name and number.isdigit()
+
+
+def get_ip_rule_matches(waf_policy, rule_name):
+    """ Returns (value, rule name) for the ip match values of an ip allow list rule, including any {rule_name}-{n}
+    rules written by earlier versions. """
+    matches = []
+    for rule in waf_policy.custom_rules or []:
+        if _is_ip_rule(rule, rule_name):
+            for condition in rule.match_conditions or []:
+                if condition.operator == 'IPMatch':
+                    matches.extend((value, rule.name) for value in condition.match_values or [])
+    return matches
+
 
-    waf_policy = client.get(resource_group_name, policy_name)
-    waf_policy_location = waf_policy.location.lower().replace(' ', '')
+def get_ip_rule_values(waf_policy, rule_name):
+    """ Returns the ip match values of an ip allow list rule, including any {rule_name}-{n} rules. """
+    return [value for value, _ in get_ip_rule_matches(waf_policy, rule_name)]
 
-    # WebApplicationFirewallCustomRule,
-    MatchCondition, MatchVariable = cmd.get_models(
+
+def set_ip_rules(cmd, waf_policy, rule_name, values, priority):
+    """ Replaces an ip allow list rule in the policy with one rule that blocks requests from addresses
+    that are not in any of its conditions (negated conditions are ANDed). The values are split into
+    conditions to fit the waf service limits. Any {rule_name}-{n} rules are removed. """
+    WebApplicationFirewallCustomRule, MatchCondition, MatchVariable = cmd.get_models(
         'WebApplicationFirewallCustomRule', 'MatchCondition', 'MatchVariable',
         resource_type=ResourceType.MGMT_NETWORK)
 
-    ips = get_azure_rp_ips(cmd, waf_policy_location, locations)
+    # a single rule is the only way to give every address the same treatment, allow rules
+    # stop evaluation, so their addresses would skip the managed rule sets
+    conditions = pack_match_values(values, rule_name)
+
+    other_rules = [r for r in waf_policy.custom_rules or [] if not _is_ip_rule(r, rule_name)]
+    if len(other_rules) + 1 > WAF_MAX_CUSTOM_RULES:
+        raise CLIError(f'Unable to add the {rule_name} waf rule, the policy has {len(other_rules)} custom rules')
+
+    ip_rule = WebApplicationFirewallCustomRule(
+        name=rule_name,
+        priority=priority,
+        rule_type='MatchRule',
+        action='Block',
+        match_conditions=[MatchCondition(
+            match_variables=[MatchVariable(variable_name='RemoteAddr')],
+            operator='IPMatch',
+            negation_conditon=True,
+            match_values=condition_values
+        ) for condition_values in conditions]
+    )
+
+    waf_policy.custom_rules = other_rules + [ip_rule]
+    return ip_rule
+
+
+def diff_ip_values(current, desired):
+    """ Returns the (added, removed) prefixes between two lists of ips, comparing the addresses
+    they cover rather than the strings, i.e. 10.0.0.0/25 + 10.0.0.128/25 equals 10.0.0.0/24. """
+    current_set, desired_set = IPRangeSet(current), IPRangeSet(desired)
+    return desired_set.subtract(current_set).to_prefixes(), current_set.subtract(desired_set).to_prefixes()
+
+
+def update_ip_rules(cmd, client, resource_group_name, waf_policy, rule_name, values, priority):
+    """ Writes the ip allow list rules to the policy only if the addresses they allow change.
+    The write is conditional on the policy's etag, so a concurrent update fails with 412 rather
+    than being overwritten. Returns a report of the prefixes added and removed. """
+    added, removed = diff_ip_values(get_ip_rule_values(waf_policy, rule_name), values)
+    # allow rules written by earlier versions are replaced even if the addresses don't change
+    legacy = any(r.name != rule_name and _is_ip_rule(r, rule_name) for r in waf_policy.custom_rules or [])
+
+    if added or removed or legacy:
+        logger.info('Updating %s: %d prefixes added, %d prefixes removed', rule_name, len(added), len(removed))
+        set_ip_rules(cmd, waf_policy, rule_name, values, priority)
+        headers = {'If-Match': waf_policy.etag} if waf_policy.etag else None
+        client.create_or_update(resource_group_name, waf_policy.name, waf_policy, headers=headers)
+    else:
+        logger.info('%s already allows the requested addresses, skipping update', rule_name)
+
+    return {'updated': bool(added or removed or legacy), 'added': added, 'removed': removed}
+
+
+def _is_precondition_failed(err):
+    if isinstance(err, HttpResponseError) and err.status_code == 412:
+        logger.info('Resource was modified concurrently, re-reading and retrying')
+        return True
+    return False
+
+
+def update_waf_policy(cmd, resource_group_name, policy_name, update):
+    """ Calls update(client, waf_policy) with a fresh read of the policy until its conditional
+    write doesn't conflict with a concurrent one. """
+    client = network_client_factory(cmd.cli_ctx).web_application_firewall_policies
+
+    def _update():
+        waf_policy = client.get(resource_group_name, policy_name)
+        return update(client, waf_policy)
 
-    match_conditions = [MatchCondition(
-        match_variables=[MatchVariable(variable_name='RemoteAddr')],
-        operator='IPMatch',
-        negation_conditon=True,
-        match_values=i
-    ) for i in ips]
+    return retry_call(_update, _is_precondition_failed, tries=CONFLICT_TRIES, deadline=None)
 
-    custom_rule = find_child_item(waf_policy, API_WAF_RULE_NAME, path='custom_rules', key_path='name')
-    custom_rule.match_conditions = match_conditions
 
-    upsert_to_collection(waf_policy, 'custom_rules', custom_rule, 'name', warn=False)
+def update_api_waf_policy(cmd, prefix, resource_group_name, locations, merge=False):
+    """ Sets the api waf allow list to the Azure Cloud ips of locations. With merge the ips already
+    in the policy are kept, so concurrent updates adding different locations never drop each other. """
 
-    parent = client.create_or_update(resource_group_name, policy_name, waf_policy)
+    def _update(client, waf_policy):
+        waf_policy_location = waf_policy.location.lower().replace(' ', '')
+        ips = get_azure_rp_ips(cmd, waf_policy_location, locations)
+        if merge:
+            ips.append(get_ip_rule_values(waf_policy, API_WAF_RULE_NAME))
+        ips = aggregate_azure_rp_ips(ips)
+        return update_ip_rules(cmd, client, resource_group_name, waf_policy, API_WAF_RULE_NAME, ips,
+                               API_WAF_RULE_PRIORITY)
 
-    return find_child_item(parent, API_WAF_RULE_NAME, path='custom_rules', key_path='name')
+    return update_waf_policy(cmd, resource_group_name, get_api_waf_name(prefix), _update)
 
 
 def add_ips_gateway_waf_policy(cmd, prefix, resource_group_name, ips):
-    policy_name = get_gateway_waf_name(prefix)
+    """ Adds ips to the gateway allow list in a single write, folding them into the ranges already allowed. """
 
-    client = network_client_factory(cmd.cli_ctx).web_application_firewall_policies
+    def _update(client, waf_policy):
+        match_ips = IPRangeSet(get_ip_rule_values(waf_policy, GATEWAY_WAF_RULE_NAME)).union(IPRangeSet(ips))
+        match_ips = match_ips.to_prefixes()
 
-    waf_policy = client.get(resource_group_name, policy_name)
-    # waf_policy_location = waf_policy.location.lower().replace(' ', '')
+        result = update_ip_rules(cmd, client, resource_group_name, waf_policy, GATEWAY_WAF_RULE_NAME, match_ips,
+                                 GATEWAY_WAF_RULE_PRIORITY)
+        result['ips'] = match_ips
+        return result
 
-    try:
-        custom_rule = find_child_item(waf_policy, GATEWAY_WAF_RULE_NAME, path='custom_rules', key_path='name')
-    except CLIError:
-        WebApplicationFirewallCustomRule, MatchCondition, MatchVariable = cmd.get_models(
-            'WebApplicationFirewallCustomRule', 'MatchCondition', 'MatchVariable',
-            resource_type=ResourceType.MGMT_NETWORK)
-
-        custom_rule = WebApplicationFirewallCustomRule(
-            name=GATEWAY_WAF_RULE_NAME,
-            priority=8,
-            rule_type='MatchRule',
-            action='Block',
-            match_conditions=[MatchCondition(
-                match_variables=[MatchVariable(variable_name='RemoteAddr')],
-                operator='IPMatch',
-                negation_conditon=True,
-                match_values=[]
-            )]
-        )
-
-    match_ips = custom_rule.match_conditions[0].match_values
-
-    for ip in ips:
-        if ip not in match_ips:
-            match_ips.append(ip)
-
-    custom_rule.match_conditions[0].match_values = match_ips
-
-    upsert_to_collection(waf_policy, 'custom_rules', custom_rule, 'name', warn=False)
-    client.create_or_update(resource_group_name, policy_name, waf_policy)
-    return match_ips
+    return update_waf_policy(cmd, resource_group_name, get_gateway_waf_name(prefix), _update)
 
 
 def remove_ips_gateway_waf_policy(cmd, prefix, resource_group_name, ips):
-    policy_name = get_gateway_waf_name(prefix)
+    """ Removes the addresses covered by ips from the gateway allow list in a single write. """
 
-    client = network_client_factory(cmd.cli_ctx).web_application_firewall_policies
+    def _update(client, waf_policy):
+        # removing part of an allowed range leaves the rest of it allowed
+        match_ips = IPRangeSet(get_ip_rule_values(waf_policy, GATEWAY_WAF_RULE_NAME)).subtract(ips)
+        match_ips = match_ips.to_prefixes()
 
-    waf_policy = client.get(resource_group_name, policy_name)
-    # waf_policy_location = waf_policy.location.lower().replace(' ', '')
-
-    try:
-        custom_rule = find_child_item(waf_policy, GATEWAY_WAF_RULE_NAME, path='custom_rules', key_path='name')
-    except CLIError:
-        WebApplicationFirewallCustomRule, MatchCondition, MatchVariable = cmd.get_models(
-            'WebApplicationFirewallCustomRule', 'MatchCondition', 'MatchVariable',
-            resource_type=ResourceType.MGMT_NETWORK)
+        # without the rule every address would be allowed, and a rule can't have an empty condition
+        if not match_ips:
+            raise CLIError(f'Unable to remove every address from the {GATEWAY_WAF_RULE_NAME} allow list, the gateway '
+                           'would be open to all addresses. Add the addresses that should be allowed first')
 
-        custom_rule = WebApplicationFirewallCustomRule(
-            name=GATEWAY_WAF_RULE_NAME,
-            priority=8,
-            rule_type='MatchRule',
-            action='Block',
-            match_conditions=[MatchCondition(
-                match_variables=[MatchVariable(variable_name='RemoteAddr')],
-                operator='IPMatch',
-                negation_conditon=True,
-                match_values=[]
-            )]
-        )
+        result = update_ip_rules(cmd, client, resource_group_name, waf_policy, GATEWAY_WAF_RULE_NAME, match_ips,
+                                 GATEWAY_WAF_RULE_PRIORITY)
+        result['ips'] = match_ips
+        return result
 
-    match_ips = []
+    return update_waf_policy(cmd, resource_group_name, get_gateway_waf_name(prefix), _update)
 
-    for ip in custom_rule.match_conditions[0].match_values:
-        if ip not in ips:
-            match_ips.append(ip)
 
-    custom_rule.match_conditions[0].match_values = match_ips
+def check_ips(cmd, prefix, resource_group_name, ips):
+    """ Reports, for each address, the gateway and api allow list rule and prefix that allow it.
+    A policy without the allow list rule doesn't block any address, so every address is reported allowed. """
+    client = network_client_factory(cmd.cli_ctx).web_application_firewall_policies
 
-    # TODO: if ips is empty, delete the rule
+    indexes = {}
+    for key, policy_name, rule_name in [('gateway', get_gateway_waf_name(prefix), GATEWAY_WAF_RULE_NAME),
+                                        ('api', get_api_waf_name(prefix), API_WAF_RULE_NAME)]:
+        waf_policy = client.get(resource_group_name, policy_name)
+        if any(_is_ip_rule(r, rule_name) for r in waf_policy.custom_rules or []):
+            indexes[key] = IPPrefixIndex(get_ip_rule_matches(waf_policy, rule_name))
+        else:
+            logger.warning('No %s allow list is configured in %s, all addresses are allowed', key, policy_name)
+            indexes[key] = None
+
+    matches = {key: index.lookup_many(ips) for key, index in indexes.items() if index is not None}
+
+    result = []
+    for i, ip in enumerate(ips):
+        item = {'address': ip}
+        for key, index in indexes.items():
+            if index is None:
+                item[f'{key}Allowed'] = True
+                item[f'{key}Rule'] = None
+                item[f'{key}Prefix'] = None
+                item[f'{key}Note'] = 'No allow list is configured'
+                continue
+            match = matches[key][i]
+            item[f'{key}Allowed'] = match is not None
+            item[f'{key}Rule'] = match[1] if match else None
+            item[f'{key}Prefix'] = match[0] if match else None
+        result.append(item)
 
-    upsert_to_collection(waf_policy, 'custom_rules', custom_rule, 'name', warn=False)
-    client.create_or_update(resource_group_name, policy_name, waf_policy)
-    return match_ips
+    return result
 
 
 def _asn1_to_iso8601(asn1_date):
@@ -337,7 +684,21 @@ def import_certificate(cmd, vault_name, certificate_name, certificate_data,
     return result, cn, secret_url
 
 
-def create_subnet(cmd, vnet, subnet_name, address_prefix):
+def keyvault_secret_exists(cmd, secret_url):
+    from azure.keyvault.models import KeyVaultErrorException  # pylint: disable=import-outside-toplevel
+    from ._client_factory import keyvault_data_client_factory  # pylint: disable=import-outside-toplevel
+    vault_base_url, _, secret_name = secret_url.partition('/secrets/')
+    client = keyvault_data_client_factory(cmd.cli_ctx)
+    try:
+        client.get_secret(vault_base_url, secret_name.split('/')[0], '')
+        return True
+    except KeyVaultErrorException:
+        return False
+
+
+def create_subnets(cmd, vnet, subnets, progress=None):
+    """ Adds the (name, address prefix) subnets missing from the vnet with a single vnet update.
+    Returns the vnet's subnets, by name. """
     Subnet = cmd.get_models('Subnet', resource_type=ResourceType.MGMT_NETWORK)
 
     vnet_parts = parse_resource_id(vnet)
@@ -345,20 +706,34 @@ def create_subnet(cmd, vnet, subnet_name, address_prefix):
     vnet_name = vnet_parts['name']
     resource_group_name = vnet_parts['resource_group']
 
-    subnet = Subnet(name=subnet_name, address_prefix=address_prefix)
-    subnet.private_endpoint_network_policies = "Disabled"
-    subnet.private_link_service_network_policies = "Enabled"
+    client = network_client_factory(cmd.cli_ctx).virtual_networks
 
-    client = network_client_factory(cmd.cli_ctx).subnets
+    def _create():
+        vnet_resource = client.get(resource_group_name, vnet_name)
+        existing = {s.name for s in vnet_resource.subnets or []}
+        missing = [(name, prefix) for name, prefix in subnets if name not in existing]
 
-    create_poller = client.begin_create_or_update(resource_group_name, vnet_name, subnet_name, subnet)
+        if missing:
+            for subnet_name, address_prefix in missing:
+                subnet = Subnet(name=subnet_name, address_prefix=address_prefix)
+                subnet.private_endpoint_network_policies = "Disabled"
+                subnet.private_link_service_network_policies = "Enabled"
+                vnet_resource.subnets = (vnet_resource.subnets or []) + [subnet]
 
-    result = LongRunningOperation(cmd.cli_ctx, start_msg=f'Creating {subnet_name}',
-                                  finish_msg=f'Finished creating {subnet_name}')(create_poller)
+            names = ', '.join(name for name, _ in missing)
+            # the vnet put includes the existing subnets, so it's conditional on nothing changing since the get
+            headers = {'If-Match': vnet_resource.etag} if vnet_resource.etag else None
+            create_poller = client.begin_create_or_update(resource_group_name, vnet_name, vnet_resource,
+                                                          headers=headers)
+            _report(progress, f'Creating {names}')
+            vnet_resource = wait_for_poller(create_poller)
+            _report(progress, f'Finished creating {names}')
+            invalidate_reads(cmd.cli_ctx, 'vnet')
+            invalidate_reads(cmd.cli_ctx, 'subnet')
 
-    logger.warning(result)
+        return {s.name: s for s in vnet_resource.subnets or []}
 
-    return result
+    return retry_call(_create, _is_precondition_failed, tries=CONFLICT_TRIES, deadline=None)
 
 
 def tag_resource_group(cmd, resource_group_name, tags):
@@ -374,11 +749,34 @@ def tag_resource_group(cmd, resource_group_name, tags):
     client = resource_client_factory(cmd.cli_ctx).tags
 
     result = client.update_at_scope(scope, paramaters)
+    invalidate_reads(cmd.cli_ctx, 'tags', resource_group_name.lower())
 
     return result
 
 
+def add_resource_group_locations(cmd, resource_group_name, locations):
+    """ Adds a location tag for each of locations and returns all the gateway's locations. Tags are merged
+    by key and each location has its own, so concurrent calls adding different locations never drop each other's. """
+    tags = {tag_key(f'{LOCATION_TAG_PREFIX}{loc}'): loc for loc in locations}
+
+    current = get_resource_group_tags(cmd, resource_group_name) or {}
+    count = len(current) + sum(1 for key in tags if key not in current)
+    if count > RESOURCE_GROUP_MAX_TAGS:
+        raise CLIError(f'Unable to add the {", ".join(locations)} location tags to resource group '
+                       f'{resource_group_name}, it would have {count} tags, more than the '
+                       f'{RESOURCE_GROUP_MAX_TAGS} a resource group can have. Remove tags that are not used '
+                       'by the gateway from the resource group and try again')
+
+    tag_resource_group(cmd, resource_group_name, tags)
+    return get_tag_locations(get_resource_group_tags(cmd, resource_group_name))
+
+
 def get_resource_group_tags(cmd, resource_group_name):
+    return cached_read(cmd.cli_ctx, ('tags', resource_group_name.lower()), _get_resource_group_tags, cmd,
+                       resource_group_name)
+
+
+def _get_resource_group_tags(cmd, resource_group_name):
     sub = get_subscription_id(cmd.cli_ctx)
     scope = resource_id(subscription=sub, resource_group=resource_group_name)
 
@@ -6,16 +6,19 @@
 
 import requests
 from knack.log import get_logger
-from azure.cli.core.util import should_disable_connection_verify
 from azure.cli.core.azclierror import (MutuallyExclusiveArgumentError, ResourceNotFoundError,
                                        ClientRequestError)
+from ._cache_utils import get_json
+from ._http_utils import retry_call
 
 ERR_TMPL_PRDR_INDEX = 'Unable to get provider index.\n'
 ERR_TMPL_NON_200 = f'{ERR_TMPL_PRDR_INDEX}Server returned status code {{}} for {{}}'
+ERR_TMPL_NOT_FOUND = f'{ERR_TMPL_PRDR_INDEX}No index exists at {{}}'
 ERR_TMPL_NO_NETWORK = f'{ERR_TMPL_PRDR_INDEX}Please ensure you have network connection. Error detail: {{}}'
 ERR_TMPL_BAD_JSON = f'{ERR_TMPL_PRDR_INDEX}Response body does not contain valid json. Error detail: {{}}'
 
-TRIES = 3
+RELEASES_URL = 'https://github.com/colbylwilliams/lab-gateway/releases'
+
 
 logger = get_logger(__name__)
 
@@ -28,8 +31,9 @@ def get_github_release(org='colbylwilliams', repo='lab-gateway', version=None, p
 
     url = f'https://api.github.com/repos/{org}/{repo}/releases'
 
+    # responses are cached on disk, tagged releases are immutable so they never need revalidating
     if prerelease:
-        version_res = requests.get(url, verify=not should_disable_connection_verify())
+        version_res = get_json(url)
         version_json = version_res.json()
 
         version_prerelease = next((v for v in version_json if v['prerelease']), None)
@@ -40,7 +44,7 @@ def get_github_release(org='colbylwilliams', repo='lab-gateway', version=None, p
 
     url += (f'/tags/{version}' if version else '/latest')
 
-    version_res = requests.get(url, verify=not should_disable_connection_verify())
+    version_res = get_json(url, immutable=bool(version))
 
     if version_res.status_code == 404:
         raise ResourceNotFoundError(
@@ -58,36 +62,42 @@ def get_github_latest_release_version(org='colbylwilliams', repo='lab-gateway',
 
 def github_release_version_exists(version, org='colbylwilliams', repo='lab-gateway'):
     version_url = f'https://api.github.com/repos/{org}/{repo}/releases/tags/{version}'
-    version_res = requests.get(version_url, verify=not should_disable_connection_verify())
+    version_res = get_json(version_url, immutable=True)
     return version_res.status_code < 400
 
 
-def get_index(index_url):  # pylint: disable=inconsistent-return-statements
-    for try_number in range(TRIES):
-        try:
-            response = requests.get(index_url, verify=(not should_disable_connection_verify()))
-            if response.status_code == 200:
-                return response.json()
-            msg = ERR_TMPL_NON_200.format(response.status_code, index_url)
-            raise ClientRequestError(msg)
-        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as err:
-            msg = ERR_TMPL_NO_NETWORK.format(str(err))
-            raise ClientRequestError(msg) from err
-        except ValueError as err:
-            # Indicates that url is not redirecting properly to intended index url, we stop retrying after TRIES calls
-            if try_number == TRIES - 1:
-                msg = ERR_TMPL_BAD_JSON.format(str(err))
-                raise ClientRequestError(msg) from err
-            import time  # pylint: disable=import-outside-toplevel
-            time.sleep(0.5)
-            continue
+def get_index(index_url, immutable=False):
 
+    def _get_index():
+        response = get_json(index_url, immutable=immutable)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code == 404:
+            raise ResourceNotFoundError(ERR_TMPL_NOT_FOUND.format(index_url))
+        raise ClientRequestError(ERR_TMPL_NON_200.format(response.status_code, index_url))
 
-def get_release_index(version=None, prerelease=False, index_url=None):
-    if index_url is None:
-        version = version or get_github_latest_release_version(prerelease=prerelease)
-        index_url = f'https://github.com/colbylwilliams/lab-gateway/releases/download/{version}/index.json'
-    index = get_index(index_url=index_url)
+    try:
+        # a ValueError indicates that url is not redirecting properly to intended index url
+        return retry_call(_get_index, lambda err: isinstance(err, ValueError))
+    except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as err:
+        msg = ERR_TMPL_NO_NETWORK.format(str(err))
+        raise ClientRequestError(msg) from err
+    except ValueError as err:
+        msg = ERR_TMPL_BAD_JSON.format(str(err))
+        raise ClientRequestError(msg) from err
+
+
+def get_release_index_url(version=None, prerelease=False):
+    """ Returns the index.json url for a release and whether its content is immutable. """
+    if prerelease and not version:
+        version = get_github_latest_release_version(prerelease=prerelease)
+    if version:
+        return f'{RELEASES_URL}/download/{version}/index.json', True
+    # github redirects to the asset on the latest stable release, saving a call to the releases api
+    return f'{RELEASES_URL}/latest/download/index.json', False
+
+
+def parse_release_index(index, version=None):
     gateway = index.get('gateway')
     if gateway is None:
         raise ResourceNotFoundError('Unable to get gateway node from index.json. Improper index format.')
@@ -97,9 +107,19 @@ def get_release_index(version=None, prerelease=False, index_url=None):
     artifacts = index.get('artifacts')
     if artifacts is None:
         raise ResourceNotFoundError('Unable to get artifacts node from index.json. Improper index format.')
+    version = version or gateway.get('version')
     return version, gateway, arm, artifacts
 
 
+def get_release_index(version=None, prerelease=False, index_url=None):
+    # the index for a released version never changes, custom index urls might
+    immutable = False
+    if index_url is None:
+        index_url, immutable = get_release_index_url(version, prerelease)
+    index = get_index(index_url=index_url, immutable=immutable)
+    return parse_release_index(index, version)
+
+
 def get_arm_template(arm_templates, name):
     template = arm_templates.get(name)
     if template is None:
@@ -121,5 +141,7 @@ def get_artifact(artifacts, name):
         raise ResourceNotFoundError(f'Unable to get artifact {name} url from index.json.')
     if artifact_name is None:
         raise ResourceNotFoundError(f'Unable to get artifact {name} name from index.json.')
+    # older releases don't include a content hash
+    artifact_sha256 = artifact.get('sha256')
 
-    return artifact_name, artifact_url
+    return artifact_name, artifact_url, artifact_sha256
@@ -37,6 +37,29 @@ examples:
         --ssl-cert-password DontRepeatPasswords1 \\
         --auth-msi /path/to/RDGatewayFedAuth.msi \\
         --version v0.1.1
+
+  - name: Create a new gateway in an existing vnet, using the first free address ranges for the subnets.
+    text: |
+      az lab-gateway create -g ResourceGroup -l eastus \\
+        --admin-username azureuser \\
+        --admin-password Secure1! \\
+        --ssl-cert /path/to/SSLCertificate.pfx \\
+        --ssl-cert-password DontRepeatPasswords1 \\
+        --auth-msi /path/to/RDGatewayFedAuth.msi \\
+        --vnet /subscriptions/{sub}/resourceGroups/{rg}/providers/Microsoft.Network/virtualNetworks/{vnet} \\
+        --rdgateway-subnet-address-prefix auto \\
+        --appgateway-subnet-address-prefix auto \\
+        --bastion-subnet-address-prefix auto
+
+  - name: Redeploy only the gateway scale set of an existing gateway.
+    text: |
+      az lab-gateway create -g ResourceGroup -l eastus \\
+        --admin-username azureuser \\
+        --admin-password Secure1! \\
+        --ssl-cert /path/to/SSLCertificate.pfx \\
+        --ssl-cert-password DontRepeatPasswords1 \\
+        --auth-msi /path/to/RDGatewayFedAuth.msi \\
+        --stage vmss
 """
 
 helps['lab-gateway show'] = """
@@ -73,3 +96,43 @@ examples:
   - name: Get the Gateway token.
     text: az lab-gateway token show -g ResourceGroup
 """
+
+helps['lab-gateway ip'] = """
+type: group
+short-summary: Manage the IP addresses allowed to access a gateway.
+"""
+
+helps['lab-gateway ip add'] = """
+type: command
+short-summary: Allow IP addresses or ranges to access a gateway.
+long-summary: Addresses and ranges already covered by the allow list are ignored, and adjacent ranges are merged.
+examples:
+  - name: Allow a single address and a range.
+    text: az lab-gateway ip add -g ResourceGroup --ips 203.0.113.5 198.51.100.0/24
+  - name: Allow the addresses and ranges listed in a file.
+    text: az lab-gateway ip add -g ResourceGroup --ips-file campus-ips.txt
+  - name: Allow the addresses and ranges read from stdin.
+    text: cat campus-ips.txt | az lab-gateway ip add -g ResourceGroup --ips-file -
+"""
+
+helps['lab-gateway ip remove'] = """
+type: command
+short-summary: Remove IP addresses or ranges from a gateway's allow list.
+long-summary: Removing part of an allowed range removes only those addresses, the rest of the range stays allowed. The allow list can't be emptied, a gateway without one is open to every address.
+examples:
+  - name: Remove a single address and a range.
+    text: az lab-gateway ip remove -g ResourceGroup --ips 203.0.113.5 198.51.100.0/24
+  - name: Remove the addresses and ranges listed in a file.
+    text: az lab-gateway ip remove -g ResourceGroup --ips-file campus-ips.txt
+"""
+
+helps['lab-gateway ip check'] = """
+type: command
+short-summary: Check whether IP addresses are allowed by a gateway's allow lists.
+long-summary: For each address, reports the rule and prefix that allow it in the gateway's AllowKnownIPs rule (gateway) and the API's AllowAzureCloudIPs rule (api). An address a rule doesn't allow is blocked by that policy. A policy without its allow list rule blocks no addresses, those are reported allowed with a note.
+examples:
+  - name: Check a few addresses.
+    text: az lab-gateway ip check -g ResourceGroup --ips 203.0.113.5 198.51.100.7 -o table
+  - name: Check the addresses listed in a file.
+    text: az lab-gateway ip check -g ResourceGroup --ips-file student-ips.txt
+"""
@@ -0,0 +1,164 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import random
+import threading
+from time import sleep, monotonic
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from knack.log import get_logger
+from azure.cli.core.util import should_disable_connection_verify
+from azure.cli.core.azclierror import ClientRequestError
+
+TRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+DEADLINE = 120
+
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# consecutive failures before a host's circuit opens, and how long it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+POOL_MAXSIZE = 16
+
+logger = get_logger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(ClientRequestError):
+    pass
+
+
+def get_session():
+    """ Returns the process wide keep-alive session used for all outbound http calls. """
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.verify = not should_disable_connection_verify()
+            _session = session
+        return _session
+
+
+def get_retry_after(response):
+    """ Returns the seconds requested by a Retry-After header, or None. """
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(try_number, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """ Exponential backoff with full jitter. """
+    return random.uniform(0, min(maximum, base * (2 ** try_number)))
+
+
+def _check_breaker(host):
+    with _breakers_lock:
+        _, opened_at = _breakers.get(host, (0, None))
+    if opened_at is not None and monotonic() - opened_at < BREAKER_COOLDOWN:
+        raise CircuitOpenError(f'Too many consecutive failures calling {host}, not retrying for now')
+
+
+def _record_result(host, success):
+    with _breakers_lock:
+        if success:
+            _breakers.pop(host, None)
+            return
+        failures, opened_at = _breakers.get(host, (0, None))
+        failures += 1
+        if failures >= BREAKER_THRESHOLD:
+            opened_at = monotonic()
+        _breakers[host] = (failures, opened_at)
+
+
+def retry_call(func, should_retry, host=None, tries=TRIES, deadline=DEADLINE):
+    """ Calls func until it succeeds, should_retry(err) is false, tries are exhausted or the
+    deadline (seconds, across all tries) would be exceeded. Waits use exponential backoff with
+    jitter, or the Retry-After of the error's response when it has one. """
+    start = monotonic()
+    try_number = 0
+    while True:
+        if host:
+            _check_breaker(host)
+        try:
+            result = func()
+        except Exception as err:  # pylint: disable=broad-except
+            retryable = should_retry(err)
+            # only transient failures count towards opening the circuit
+            if host and retryable:
+                _record_result(host, False)
+            if not retryable or try_number >= tries - 1:
+                raise
+            delay = get_retry_after(getattr(err, 'response', None))
+            if delay is None:
+                delay = get_backoff(try_number)
+            if deadline is not None and monotonic() - start + delay > deadline:
+                raise
+            logger.info('Retrying in %.1f seconds after error: %s', delay, err)
+            sleep(delay)
+            try_number += 1
+            continue
+        if host:
+            _record_result(host, True)
+        return result
+
+
+class RetryableStatusError(requests.exceptions.HTTPError):
+    pass
+
+
+def _is_transient(err):
+    return isinstance(err, (RetryableStatusError, requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+def request(method, url, tries=TRIES, deadline=DEADLINE, **kwargs):
+    """ Sends a request on the shared session, retrying connection errors and transient status
+    codes. Non-transient responses are returned to the caller as is. """
+    host = urlparse(url).netloc
+
+    def _send():
+        response = get_session().request(method, url, **kwargs)
+        if response.status_code in RETRY_STATUS_CODES:
+            response.close()
+            raise RetryableStatusError(f'Server returned status code {response.status_code} for {url}',
+                                       response=response)
+        return response
+
+    try:
+        return retry_call(_send, _is_transient, host=host, tries=tries, deadline=deadline)
+    except RetryableStatusError as err:
+        return err.response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
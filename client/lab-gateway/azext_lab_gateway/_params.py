@@ -12,6 +12,7 @@ from azure.cli.core.commands.parameters import (get_location_type, tags_type,
                                                 get_resource_group_completion_list,)
 
 from ._validators import (certificate_type, msi_type)
+from ._constants import DEPLOY_STAGES
 from ._completers import (subnet_completion_list, get_resource_name_completion_list,
                           get_lab_name_completion_list)
 
@@ -33,8 +34,7 @@ gateway_resource_group_name_type = CLIArgumentType(
 
 def load_arguments(self, _):
 
-    # for scope in ['lab-gateway create', 'lab-gateway show', 'lab-gateway lab connect', 'lab-gateway token show', 'lab-gateway ip']:
-    for scope in ['lab-gateway create', 'lab-gateway show', 'lab-gateway lab connect', 'lab-gateway token show']:
+    for scope in ['lab-gateway create', 'lab-gateway show', 'lab-gateway lab connect', 'lab-gateway token show', 'lab-gateway ip']:
         with self.argument_context(scope) as c:
             c.ignore('resource_prefix')
 
@@ -43,6 +43,7 @@ def load_arguments(self, _):
             c.argument('version', options_list=['--version', '-v'], help='Gateway version. Default: latest stable.', arg_group='Advanced')
             c.argument('prerelease', options_list=['--pre'], action='store_true', help='Deploy latest prerelease version.', arg_group='Advanced')
             c.argument('index_url', help='URL to custom index.json file.', arg_group='Advanced')
+            c.ignore('index')
 
     # lab-gateway create uses a command level validator, param validators will be ignored
     # for scope in ['lab-gateway create', 'lab-gateway test']:
@@ -71,19 +72,28 @@ def load_arguments(self, _):
 
         subnet_help = 'Name or ID of an existing subnet in vnet provided for --vnet. Will create a new subnet if a subnet with the name does not exist.'
         c.argument('rdgateway_subnet', completer=subnet_completion_list, arg_group='Network', help=subnet_help)
-        c.argument('rdgateway_subnet_address_prefix', arg_group='Network', help='The CIDR prefix to use when creating the RDGateway subnet')
+        c.argument('rdgateway_subnet_address_prefix', arg_group='Network', help='The CIDR prefix to use when creating the RDGateway subnet. Use auto to allocate the first free range in the vnet.')
 
         c.argument('appgateway_subnet', completer=subnet_completion_list, arg_group='Network', help=subnet_help)
-        c.argument('appgateway_subnet_address_prefix', arg_group='Network', help='The CIDR prefix to use when creating the App Gateway subnet')
+        c.argument('appgateway_subnet_address_prefix', arg_group='Network', help='The CIDR prefix to use when creating the App Gateway subnet. Use auto to allocate the first free range in the vnet.')
 
         c.argument('bastion_subnet', completer=subnet_completion_list, arg_group='Network', help=subnet_help)
-        c.argument('bastion_subnet_address_prefix', arg_group='Network', help='The CIDR prefix to use when creating the Bastion Host subnet')
+        c.argument('bastion_subnet_address_prefix', arg_group='Network', help='The CIDR prefix to use when creating the Bastion Host subnet. Use auto to allocate the first free range in the vnet.')
 
-        c.argument('private_ip_address', arg_group='Network', help='Private IP Address. Must be within AppGatewaySubnet address prefix and cannot end in .0 - .4 (reserved)')
+        c.argument('private_ip_address', arg_group='Network', help='Private IP Address. Must be within AppGatewaySubnet address prefix and cannot end in .0 - .4 (reserved). Use auto to use the first usable address of the subnet.')
 
         public_ip_help = 'Name or ID of an existing Public IP Address resource. Must be in the same resource group and location as the gateway. Will create new resource if none is specified.'
         c.argument('public_ip_address', help=public_ip_help, completer=get_resource_name_completion_list('Microsoft.Network/publicIPAddresses'), arg_group='Network')
 
+        c.argument('force', action='store_true', arg_group='Advanced',
+                   help='Redeploy the ARM templates even if the templates and parameters are unchanged since the last deployment.')
+
+        c.argument('resume', action='store_true', arg_group='Advanced',
+                   help='Resume a failed create, skipping the steps that completed (and whose resources still exist) in the previous run for the same resource group and version.')
+
+        c.argument('stage', arg_group='Advanced', choices=list(DEPLOY_STAGES),
+                   help='Redeploy only this stage of the solution, reusing the outputs of the last deployment of the other stages. Requires a version that deploys the solution in stages.')
+
         c.ignore('vnet_type')
         c.ignore('rdgateway_subnet_type')
         c.ignore('appgateway_subnet_type')
@@ -106,7 +116,14 @@ def load_arguments(self, _):
             # c.argument('location', get_location_type(self.cli_ctx))
             c.ignore('gateway_function_name')
 
-    # for scope in ['lab-gateway ip add', 'lab-gateway ip remove']:
-    #     with self.argument_context(scope) as c:
-    #         c.argument('ips', nargs='+',
-    #                    help='Space-separated IP addresses or ranges to allow access to gateway.')
+    for scope in ['lab-gateway ip add', 'lab-gateway ip remove']:
+        with self.argument_context(scope) as c:
+            c.argument('ips', nargs='+',
+                       help='Space-separated IP addresses or CIDR ranges to allow access to gateway.')
+            c.argument('ips_file', completer=FilesCompleter(),
+                       help='Path to a file with IP addresses or CIDR ranges separated by whitespace, commas or newlines. Text after # is ignored. Use - to read from stdin.')
+
+    with self.argument_context('lab-gateway ip check') as c:
+        c.argument('ips', nargs='+', help='Space-separated IP addresses to check.')
+        c.argument('ips_file', completer=FilesCompleter(),
+                   help='Path to a file with IP addresses separated by whitespace, commas or newlines. Text after # is ignored. Use - to read from stdin.')
@@ -0,0 +1,139 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import hashlib
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from knack.log import get_logger
+from azure.core.exceptions import HttpResponseError
+from azure.cli.core.profiles import ResourceType, get_sdk
+from azure.cli.core.azclierror import AzureResponseError
+
+from ._http_utils import (get as http_get, head as http_head, CircuitOpenError)
+
+MAX_WORKERS = 8
+CHUNK_SIZE = 4 * 1024 * 1024
+COPY_POLL_INTERVAL = 1
+COPY_POLL_INTERVAL_MAX = 10
+COPY_TIMEOUT = 600
+
+HASH_METADATA_KEY = 'sha256'
+
+logger = get_logger(__name__)
+
+
+def get_blob_service_client(cmd, connection_string):
+    BlobServiceClient = get_sdk(cmd.cli_ctx, ResourceType.DATA_STORAGE_BLOB,
+                                '_blob_service_client#BlobServiceClient')
+    return BlobServiceClient.from_connection_string(connection_string)
+
+
+def get_blob_hashes(blob_service_client, container_name):
+    """ Lists the container once and returns {name: (sha256, content_md5)} for every blob. """
+    container_client = blob_service_client.get_container_client(container_name)
+    hashes = {}
+    for blob in container_client.list_blobs(include=['metadata']):
+        metadata = blob.metadata or {}
+        content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+        hashes[blob.name] = (metadata.get(HASH_METADATA_KEY), bytes(content_md5) if content_md5 else None)
+    return hashes
+
+
+def blob_is_current(blob_hashes, name, sha256=None, md5=None):
+    """ Whether the listed blob already holds the content identified by sha256 (or md5). """
+    if name not in blob_hashes:
+        return False
+    blob_sha256, blob_md5 = blob_hashes[name]
+    if sha256 and blob_sha256:
+        return blob_sha256 == sha256
+    if md5 and blob_md5:
+        return blob_md5 == md5
+    # nothing to compare against (i.e. an index.json without hashes), keep the existing blob
+    return not sha256 and not md5
+
+
+def upload_blob_if_changed(blob_service_client, container_name, name, data, blob_hashes):
+    """ Uploads local data unless the blob already holds the same bytes. """
+    sha256 = hashlib.sha256(data).hexdigest()
+    md5 = hashlib.md5(data).digest()
+    if blob_is_current(blob_hashes, name, sha256, md5):
+        logger.info('Skipping upload of %s, blob is current', name)
+        return False
+    blob_client = blob_service_client.get_blob_client(container_name, name)
+    blob_client.upload_blob(data, overwrite=True, metadata={HASH_METADATA_KEY: sha256})
+    return True
+
+
+def copy_artifacts(blob_service_client, container_name, artifact_items, blob_hashes):
+    """ Copies (name, url, sha256) artifacts whose content changed into the container
+    concurrently and waits for all of them. """
+    changed = []
+    for item in artifact_items:
+        if blob_is_current(blob_hashes, item[0], sha256=item[2]):
+            logger.info('Skipping copy of %s, blob is current', item[0])
+        else:
+            changed.append(item)
+
+    if not changed:
+        return []
+
+    def _copy(item):
+        artifact_name, artifact_url, sha256 = item
+        blob_client = blob_service_client.get_blob_client(container_name, artifact_name)
+        copy_blob_from_url(blob_client, artifact_url, metadata={HASH_METADATA_KEY: sha256} if sha256 else None)
+        return artifact_name
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(changed))) as executor:
+        # list() waits on every copy and raises the first error
+        return list(executor.map(_copy, changed))
+
+
+def copy_blob_from_url(blob_client, url, metadata=None):
+    """ Copies a blob from a public url server-side, falling back to streaming it through the client. """
+    try:
+        # github release downloads redirect to a short lived signed url which
+        # the storage service will not follow, so resolve it before starting the copy
+        source_url = _resolve_url(url)
+        blob_client.start_copy_from_url(source_url, metadata=metadata)
+        status = _wait_for_copy(blob_client)
+        if status == 'success':
+            return
+        logger.info('Server-side copy of %s finished with status %s', blob_client.blob_name, status)
+    except (HttpResponseError, requests.exceptions.RequestException, CircuitOpenError) as err:
+        logger.info('Server-side copy of %s failed: %s', blob_client.blob_name, err)
+
+    logger.info('Streaming %s to storage', blob_client.blob_name)
+    stream_blob_from_url(blob_client, url, metadata=metadata)
+
+
+def stream_blob_from_url(blob_client, url, metadata=None):
+    """ Pipes a download into a blob in fixed size chunks so memory use stays bounded. """
+    with http_get(url, stream=True) as response:
+        if response.status_code != 200:
+            raise AzureResponseError(f'Server returned status code {response.status_code} for {url}')
+        length = response.headers.get('Content-Length')
+        blob_client.upload_blob(response.iter_content(chunk_size=CHUNK_SIZE), overwrite=True,
+                                length=int(length) if length else None, metadata=metadata)
+
+
+def _resolve_url(url):
+    response = http_head(url, allow_redirects=True)
+    response.raise_for_status()
+    return response.url
+
+
+def _wait_for_copy(blob_client):
+    interval, waited = COPY_POLL_INTERVAL, 0
+    while True:
+        copy = blob_client.get_blob_properties().copy
+        if copy.status != 'pending' or waited >= COPY_TIMEOUT:
+            if copy.status == 'pending':
+                blob_client.abort_copy(copy.id)
+            return copy.status
+        sleep(interval)
+        waited += interval
+        interval = min(interval * 2, COPY_POLL_INTERVAL_MAX)
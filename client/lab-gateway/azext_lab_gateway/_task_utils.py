@@ -0,0 +1,155 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import os
+import queue
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from knack.log import get_logger
+from knack.util import CLIError
+
+from ._cache_utils import (get_cache_dir, file_lock, read_json_file, write_json_file)
+
+MAX_WORKERS = 4
+
+# how often progress reported by running steps is passed to the hook
+PROGRESS_INTERVAL = 1
+
+JOURNAL_DIR_NAME = 'journals'
+
+logger = get_logger(__name__)
+
+
+class StaleStepError(Exception):
+    pass
+
+
+class StepJournal:
+    """ Records the results of completed steps on disk, keyed by the parts identifying the run
+    (i.e. subscription, resource group and version), so a failed run can be resumed. """
+
+    def __init__(self, *key):
+        self.key = '/'.join(str(k).lower() for k in key)
+        self.path = get_cache_dir(JOURNAL_DIR_NAME, hashlib.sha256(self.key.encode('utf-8')).hexdigest() + '.json')
+        self.steps = {}
+
+    def load(self):
+        with file_lock(self.path):
+            journal = read_json_file(self.path)
+        self.steps = journal['steps'] if journal and journal.get('key') == self.key else {}
+        return self
+
+    def get(self, name):
+        return self.steps.get(name)
+
+    def record(self, name, value):
+        self.steps[name] = value
+        with file_lock(self.path):
+            write_json_file(self.path, {'key': self.key, 'steps': self.steps})
+
+    def clear(self):
+        self.steps = {}
+        with file_lock(self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class TaskGraph:
+    """ Runs a set of steps on a bounded thread pool, starting each step as soon as
+    the steps it requires have completed. A step is called with the results of its
+    required steps, in the order they were listed.
+
+    With a journal, the result of each step added with a load function is recorded
+    (as save(result) if given) when it completes. If the journal already has a record
+    for the step, load(record) is called in place of the step, and the step only runs
+    if that raises StaleStepError, i.e. the recorded resource no longer exists. """
+
+    def __init__(self, hook=None, max_workers=MAX_WORKERS, journal=None):
+        self.hook = hook
+        self.max_workers = max_workers
+        self.journal = journal
+        self._tasks = {}
+        self._messages = queue.Queue()
+
+    def report(self, message):
+        """ Queues a progress message from a running step. Messages are passed to the hook
+        from the thread running the graph. """
+        self._messages.put(message)
+
+    def _flush_messages(self):
+        while True:
+            try:
+                message = self._messages.get_nowait()
+            except queue.Empty:
+                return
+            if self.hook:
+                self.hook.add(message=message)
+            else:
+                logger.info(message)
+
+    def add(self, name, func, requires=None, message=None, save=None, load=None):
+        if name in self._tasks:
+            raise CLIError(f'Step {name} has already been added')
+
+        requires = list(requires or [])
+
+        # steps can only require steps that were added before them, so the graph can't have cycles
+        unknown = [r for r in requires if r not in self._tasks]
+        if unknown:
+            raise CLIError('Step {} requires unknown steps: {}'.format(name, ', '.join(unknown)))
+
+        self._tasks[name] = (func, requires, message, save, load)
+        return name
+
+    def _run_step(self, name, func, load, args):
+        record = self.journal.get(name) if self.journal is not None and load else None
+        if record is not None:
+            try:
+                result = load(record)
+                logger.warning('Resuming after completed step: %s', name)
+                return result
+            except StaleStepError as e:
+                logger.warning('Rerunning step %s: %s', name, e)
+        return func(*args)
+
+    def run(self):
+        results = {}
+        pending = dict(self._tasks)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while pending or running:
+                    ready = [n for n, task in pending.items() if all(r in results for r in task[1])]
+
+                    for name in ready:
+                        func, requires, message, _, load = pending.pop(name)
+                        # progress is only reported from this thread, the hook is not thread safe
+                        if message and self.hook:
+                            self.hook.add(message=message)
+                        logger.info('Starting step: %s', name)
+                        args = [results[r] for r in requires]
+                        running[executor.submit(self._run_step, name, func, load, args)] = name
+
+                    done, _ = wait(running, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                    self._flush_messages()
+
+                    for future in done:
+                        name = running.pop(future)
+                        results[name] = future.result()
+                        logger.info('Finished step: %s', name)
+                        _, _, _, save, load = self._tasks[name]
+                        if self.journal is not None and load:
+                            self.journal.record(name, save(results[name]) if save else results[name])
+
+            except BaseException:
+                # stop anything that hasn't started, steps already in flight are left to finish
+                for future in running:
+                    future.cancel()
+                raise
+
+        return results
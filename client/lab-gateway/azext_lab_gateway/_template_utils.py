@@ -0,0 +1,130 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import json
+import hashlib
+import threading
+from difflib import get_close_matches
+
+import requests
+from knack.log import get_logger
+from azure.cli.core.azclierror import (ClientRequestError, InvalidTemplateError)
+
+from ._http_utils import get as http_get
+from ._cache_utils import (get_cache_dir, file_lock, read_file, write_file)
+from ._github_utils import get_arm_template
+
+TEMPLATES_DIR_NAME = 'templates'
+
+logger = get_logger(__name__)
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(arm_templates, name):
+    """ Returns the content of the named template from index.json. Templates are downloaded once into a
+    local cache, versioned by release, and verified against the index's sha256 when it includes one. """
+    url = get_arm_template(arm_templates, name)
+    entry = arm_templates[name]
+    sha256 = entry.get('sha256')
+    version = entry.get('version')
+
+    key = (url, sha256)
+    with _templates_lock:
+        if key in _templates:
+            return _templates[key]
+
+    # a release's templates never change, so they're cached under its version. templates from
+    # a custom index with neither a version nor a hash are downloaded every time
+    folder = version or hashlib.sha256(url.encode('utf-8')).hexdigest()
+    path = get_cache_dir(TEMPLATES_DIR_NAME, folder, entry.get('name') or f'{name}.json')
+
+    with file_lock(path):
+        content = read_file(path) if version or sha256 else None
+        if content is not None and sha256 and hashlib.sha256(content).hexdigest() != sha256:
+            logger.debug('Cached template %s does not match its hash, downloading it again', path)
+            content = None
+        if content is None:
+            content = _download_template(name, url, sha256)
+            write_file(path, content)
+        else:
+            logger.debug('Using cached template %s', path)
+
+    try:
+        template = json.loads(content.decode('utf-8-sig'))
+    except ValueError as err:
+        raise InvalidTemplateError(f'Template {name} from {url} does not contain valid json: {err}') from err
+
+    with _templates_lock:
+        _templates[key] = template
+    return template
+
+
+def _download_template(name, url, sha256=None):
+    try:
+        response = http_get(url)
+    except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as err:
+        raise ClientRequestError(f'Unable to download template {name}. Please ensure you have network '
+                                 f'connection. Error detail: {err}') from err
+    if response.status_code != 200:
+        raise ClientRequestError(f'Unable to download template {name}. '
+                                 f'Server returned status code {response.status_code} for {url}')
+    content = response.content
+    if sha256 and hashlib.sha256(content).hexdigest() != sha256:
+        raise ClientRequestError(f'Template {name} downloaded from {url} does not match the sha256 in index.json')
+    return content
+
+
+def get_template_parameters(template, parameters, name='template'):
+    """ Converts lists of key=value parameters to deployment parameters, typed by the template's
+    parameter schema. Unknown, missing and mistyped parameters fail here, before anything is sent to ARM. """
+    schema = template.get('parameters') or {}
+    # parameter names are case insensitive in arm
+    names = {k.lower(): k for k in schema}
+
+    result = {}
+    for param in (p for params in parameters or [] for p in params):
+        key, sep, value = param.partition('=')
+        if not sep:
+            raise InvalidTemplateError(f"Invalid parameter '{param}' for {name}, parameters must be key=value")
+        param_name = names.get(key.lower())
+        if param_name is None:
+            matches = get_close_matches(key, list(schema), n=1)
+            hint = f", did you mean '{matches[0]}'?" if matches else ''
+            raise InvalidTemplateError(f"Template {name} has no parameter '{key}'{hint}")
+        result[param_name] = {'value': _convert_parameter(name, param_name, schema[param_name], value)}
+
+    missing = [k for k, v in schema.items() if k not in result and 'defaultValue' not in v]
+    if missing:
+        raise InvalidTemplateError('Template {} is missing values for parameters: {}'.format(name, ', '.join(missing)))
+
+    return result
+
+
+def _convert_parameter(template_name, param_name, schema, value):
+    kind = schema.get('type', 'string').lower()
+    try:
+        if kind == 'int':
+            value = int(value)
+        elif kind == 'bool':
+            if value.lower() not in ('true', 'false'):
+                raise ValueError('expected true or false')
+            value = value.lower() == 'true'
+        elif kind in ('array', 'object', 'secureobject'):
+            value = json.loads(value)
+            if not isinstance(value, list if kind == 'array' else dict):
+                raise ValueError(f'expected a json {"array" if kind == "array" else "object"}')
+    except ValueError as err:
+        # the message never includes the value, it may be a secret
+        raise InvalidTemplateError(f"Parameter '{param_name}' of template {template_name} "
+                                   f"must be of type {schema.get('type')}") from err
+
+    allowed = schema.get('allowedValues')
+    if allowed is not None and value not in allowed:
+        raise InvalidTemplateError("Parameter '{}' of template {} must be one of: {}".format(
+            param_name, template_name, ', '.join(str(a) for a in allowed)))
+
+    return value
@@ -4,14 +4,17 @@
 # --------------------------------------------------------------------------------------------
 # pylint: disable=unused-argument, protected-access, too-many-lines
 
+import json
 from knack.log import get_logger
 from msrestazure.azure_exceptions import CloudError
 from azure.graphrbac import GraphRbacManagementClient
 from azure.graphrbac.models import GraphErrorException
 from azure.cli.core._profile import Profile
+from azure.cli.core.commands import client_factory
 from azure.cli.core.util import (can_launch_browser, open_page_in_browser, in_cloud_console)
 from azure.cli.core.azclierror import AzureResponseError
-from ._constants import tag_key
+from ._constants import (TAG_PREFIX, LOCATION_TAG_PREFIX, FINGERPRINT_TAG_NAMES, tag_key)
+from ._cache_utils import cached_read
 
 TRIES = 3
 
@@ -23,6 +26,36 @@ def get_tag(tags, key):
     return val
 
 
+def get_tag_locations(tags):
+    """ Returns the gateway's locations, the json list in the locations tag written by create plus
+    the location tags added by lab connect. Raises ValueError if the locations tag isn't valid json. """
+    locations = json.loads(get_tag(tags, 'locations') or '[]')
+    prefix = tag_key(LOCATION_TAG_PREFIX)
+    for key in sorted(tags or {}):
+        if key.startswith(prefix) and key[len(prefix):] not in locations:
+            locations.append(key[len(prefix):])
+    return locations
+
+
+def get_tag_properties(tags):
+    """ Returns the gateway properties stored in the resource group's tags, keyed without the tag prefix. """
+    properties = {}
+    location_prefix = tag_key(LOCATION_TAG_PREFIX)
+    for key, value in (tags or {}).items():
+        if key.startswith(TAG_PREFIX) and not key.startswith(location_prefix):
+            name = key.split(':')[1]
+            if name not in FINGERPRINT_TAG_NAMES:
+                properties[name] = value
+    # the location tags are reported merged into the locations property
+    if any(k.startswith(location_prefix) for k in tags or {}):
+        properties['locations'] = json.dumps(get_tag_locations(tags))
+    return properties
+
+
+def get_subscription_id(cli_ctx):
+    return cached_read(cli_ctx, ('subscription',), client_factory.get_subscription_id, cli_ctx)
+
+
 def open_url_in_browser(url):
     # if we are not in cloud shell and can launch a browser, launch it with the issue draft
     if can_launch_browser() and not in_cloud_console():
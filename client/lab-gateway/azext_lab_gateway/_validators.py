@@ -5,27 +5,39 @@
 # pylint: disable=too-many-statements, too-many-locals, too-many-lines, consider-using-f-string
 
 import os
+import sys
 import json
 import ipaddress
 from re import match
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from knack.log import get_logger
 from msrestazure.tools import resource_id  # , parse_resource_id
 from azure.core.exceptions import ResourceNotFoundError
-from azure.cli.core.azclierror import (MutuallyExclusiveArgumentError, InvalidArgumentValueError)
-from azure.cli.core.commands.client_factory import get_subscription_id
+from azure.cli.core.azclierror import (MutuallyExclusiveArgumentError, InvalidArgumentValueError,
+                                       RequiredArgumentMissingError)
+from azure.cli.core.azclierror import ResourceNotFoundError as IndexNotFoundError
 from azure.cli.core.commands.validators import (get_default_location_from_resource_group,
                                                 validate_tags)
 from azure.cli.core.commands.template_create import (_validate_name_or_id)
 from azure.cli.core.extension import get_extension
 from azure.cli.core.util import hash_string
 
-from ._github_utils import (github_release_version_exists, get_github_latest_release_version)
+from ._github_utils import (get_release_index_url, get_index, parse_release_index)
 from ._deploy_utils import (get_resource_group_tags)
 from ._client_factory import (network_client_factory, labs_client_factory)
-from ._constants import (tag_key, get_resource_name, get_function_name)
-from ._utils import (get_tag, same_location)
+from ._constants import (AUTO_PREFIX, AUTO_SUBNET_PREFIX_LENGTHS, DEPLOY_STAGES, tag_key, get_resource_name,
+                         get_function_name)
+from ._utils import (get_tag, get_tag_locations, same_location, get_subscription_id)
+from ._cidr_utils import IPRangeSet
+from ._cache_utils import cached_read
 
 
+SUBNETS = ['rdgateway', 'appgateway', 'bastion']
+
+# vnet, three subnets and public ip, plus the resource group location and github index
+PREFETCH_MAX_WORKERS = 7
+
 logger = get_logger(__name__)
 
 
@@ -33,6 +45,21 @@ def none_or_empty(val):
     return val in ('', '""', "''") or val is None
 
 
+def _parts_key(parts):
+    return tuple((parts.get(k) or '').lower() for k in ('subscription', 'resource_group', 'name', 'child_name_1'))
+
+
+def cached_by_parts(kind):
+    """ Memoizes a get_*(cmd, parts) fetcher for the command invocation. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(cmd, parts):
+            return cached_read(cmd.cli_ctx, (kind, _parts_key(parts)), func, cmd, parts)
+        return wrapper
+    return decorator
+
+
+@cached_by_parts('public_ip')
 def get_public_ip(cmd, parts):
     client = network_client_factory(cmd.cli_ctx).public_ip_addresses
     rg, name = parts['resource_group'], parts['name']
@@ -45,6 +72,7 @@ def get_public_ip(cmd, parts):
         return None
 
 
+@cached_by_parts('vnet')
 def get_vnet(cmd, parts):
     client = network_client_factory(cmd.cli_ctx).virtual_networks
     rg, name = parts['resource_group'], parts['name']
@@ -57,6 +85,7 @@ def get_vnet(cmd, parts):
         return None
 
 
+@cached_by_parts('subnet')
 def get_subnet(cmd, parts):
     client = network_client_factory(cmd.cli_ctx).subnets
     rg, vnet, name = parts['resource_group'], parts['name'], parts['child_name_1']
@@ -69,6 +98,7 @@ def get_subnet(cmd, parts):
         return None
 
 
+@cached_by_parts('lab')
 def get_lab(cmd, parts):
     client = labs_client_factory(cmd.cli_ctx).labs
     rg, name = parts['resource_group'], parts['name']
@@ -94,13 +124,65 @@ def get_lab_vnets(cmd, parts):
 
 
 def process_gateway_create_namespace(cmd, ns):
-    get_default_location_from_resource_group(cmd, ns)
-    validate_resource_prefix(cmd, ns)
-    index_version_validator(cmd, ns)
-    validate_gateway_tags(ns)
-    validate_token_lifetime(cmd, ns)
-    validate_vnet(cmd, ns)
-    validate_public_ip(cmd, ns)
+    # the validators below need several independent arm and github reads, so start them all up front.
+    # the validators still run in order and each read's result (or error) is only used where the
+    # validator would have made the call, so errors are the same as validating sequentially
+    with ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS) as executor:
+        location = executor.submit(get_default_location_from_resource_group, cmd, ns)
+        index = executor.submit(index_version_validator, cmd, ns)
+        fetched = prefetch_create_resources(cmd, ns, executor)
+
+        location.result()
+        validate_resource_prefix(cmd, ns)
+        index.result()
+        validate_deploy_stage(ns)
+        validate_gateway_tags(ns)
+        validate_token_lifetime(cmd, ns)
+        validate_vnet(cmd, ns, fetched)
+        validate_public_ip(cmd, ns, fetched)
+
+
+def prefetch_create_resources(cmd, ns, executor):
+    """ Starts fetching the vnet, subnets and public ip referenced by the create arguments.
+    Returns the futures keyed for get_prefetched. Anything that can't be resolved from the
+    arguments is left for the validators to fetch (or reject) themselves. """
+    fetched = {}
+
+    def _submit(getter, parts):
+        fetched[_prefetch_key(getter, parts)] = executor.submit(getter, cmd, parts)
+
+    try:
+        vnet_parts = get_vnet_parts(cmd, ns)
+        _submit(get_vnet, vnet_parts)
+        for subnet in SUBNETS:
+            subnet_parts = get_subnet_parts(cmd, ns, subnet, vnet_parts)
+            if subnet_parts is not None:
+                _submit(get_subnet, subnet_parts)
+        if not none_or_empty(ns.public_ip_address):
+            _submit(get_public_ip, get_public_ip_parts(cmd, ns))
+    except Exception as e:  # pylint: disable=broad-except
+        logger.debug('Unable to prefetch resources: %s', e)
+
+    return fetched
+
+
+def _prefetch_key(getter, parts):
+    return getter.__name__, _parts_key(parts)
+
+
+def get_prefetched(cmd, fetched, getter, parts):
+    """ Returns the result of getter(cmd, parts), waiting for it if it was prefetched. """
+    future = (fetched or {}).get(_prefetch_key(getter, parts))
+    return future.result() if future is not None else getter(cmd, parts)
+
+
+def validate_deploy_stage(ns):
+    if ns.stage is None:
+        return
+    _, _, arm_templates, _ = ns.index
+    if not all(t in arm_templates for t in DEPLOY_STAGES.values()):
+        raise InvalidArgumentValueError(
+            f'--stage is not supported by version {ns.index[0]}, it does not include the deployB stage templates')
 
 
 def process_gateway_connect_namespace(cmd, ns):
@@ -182,8 +264,73 @@ def process_gateway_connect_namespace(cmd, ns):
 
 def process_gateway_ip_namespace(cmd, ns):
     validate_resource_prefix(cmd, ns)
-    for ip in ns.ips:
-        _ = ipaddress.ip_address(ip)
+    validate_ips(ns)
+
+
+def validate_ips(ns):
+    values = list(ns.ips or [])
+
+    if ns.ips_file:
+        values.extend(read_ip_values(ns.ips_file))
+
+    if not values:
+        raise RequiredArgumentMissingError('Provide at least one IP address or range using --ips or --ips-file')
+
+    try:
+        # dedupes values and folds addresses and ranges contained in others into them. parsing is strict,
+        # a range with host bits set (i.e. 203.0.113.5/24) is more likely a typo than a request to allow the /24
+        ns.ips = IPRangeSet(values, strict=True).to_prefixes()
+    except ValueError as e:
+        raise InvalidArgumentValueError(f'Invalid IP address or range: {e}',
+                                        recommendation=_get_host_bits_recommendation(values)) from e
+
+
+def _get_host_bits_recommendation(values):
+    for value in values:
+        try:
+            ipaddress.ip_network(value.strip(), strict=True)
+        except ValueError:
+            try:
+                network = ipaddress.ip_network(value.strip(), strict=False)
+            except ValueError:
+                return None
+            return f'Use {network} to allow the whole range of {value.strip()}, or the address without a prefix length'
+    return None
+
+
+def process_gateway_ip_check_namespace(cmd, ns):
+    validate_resource_prefix(cmd, ns)
+    validate_ip_addresses(ns)
+
+
+def validate_ip_addresses(ns):
+    values = list(ns.ips or [])
+
+    if ns.ips_file:
+        values.extend(read_ip_values(ns.ips_file))
+
+    if not values:
+        raise RequiredArgumentMissingError('Provide at least one IP address using --ips or --ips-file')
+
+    try:
+        ns.ips = [str(ipaddress.ip_address(ip)) for ip in values]
+    except ValueError as e:
+        raise InvalidArgumentValueError(f'Invalid IP address: {e}') from e
+
+
+def read_ip_values(path):
+    """ Yields the addresses and ranges in a file (or stdin if path is -), separated by
+    whitespace, commas or newlines. Text after a # is ignored. """
+    try:
+        f = sys.stdin if path == '-' else open(os.path.expanduser(path), 'r', encoding='utf-8')  # pylint: disable=consider-using-with
+    except (IOError, OSError) as e:
+        raise InvalidArgumentValueError(f"Unable to load ips file '{path}': {e.strerror}.") from e
+    try:
+        for line in f:
+            yield from line.split('#', 1)[0].replace(',', ' ').split()
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 
 def process_gateway_show_namespace(cmd, ns):
@@ -221,16 +368,14 @@ def validate_gateway_hostname(ns, tags):
 
 
 def validate_gateway_locations(ns, tags):
-    locationsj = get_tag(tags, 'locations')
-
-    if not locationsj:
-        raise ResourceNotFoundError('Unable to resolve lab locaitons resource group tags')
-
     try:
-        locations = json.loads(locationsj)
+        locations = get_tag_locations(tags)
     except json.decoder.JSONDecodeError as e:
         raise ResourceNotFoundError('Unable to resolve lab locaitons resource group tags') from e
 
+    if not locations:
+        raise ResourceNotFoundError('Unable to resolve lab locaitons resource group tags')
+
     ns.gateway_locations = locations
 
 
@@ -272,19 +417,22 @@ def validate_gateway_tags(ns):
     ns.tags = tags_dict
 
 
-def validate_vnet(cmd, ns):
-    subnets = ['rdgateway', 'appgateway', 'bastion']
-
+def get_vnet_parts(cmd, ns):
     # Create a resource ID we can check for existence.
     vnet_parts, _ = _validate_name_or_id(
         cmd.cli_ctx, ns.resource_group_name, ns.vnet, 'Microsoft.Network/virtualNetworks',
         parent_value=None, parent_type=None)
+    return vnet_parts
+
+
+def validate_vnet(cmd, ns, fetched=None):
+    vnet_parts = get_vnet_parts(cmd, ns)
 
     vnet_name = vnet_parts['name']
 
     default_prefix = hasattr(getattr(ns, 'vnet_address_prefix'), 'is_default')
 
-    vnet = get_vnet(cmd, vnet_parts)
+    vnet = get_prefetched(cmd, fetched, get_vnet, vnet_parts)
 
     if vnet is not None:
         logger.info('vnet exists: %s', vnet_name)
@@ -308,15 +456,35 @@ def validate_vnet(cmd, ns):
     prefixes = vnet.address_space.address_prefixes if vnet is not None else [
         ns.vnet_address_prefix] if ns.vnet_address_prefix is not None else None
 
-    for subnet in subnets:
-        validate_subnet(cmd, ns, subnet, vnet_parts, prefixes)
+    # address space not used by any existing subnet, new subnets with an 'auto' prefix are allocated from it
+    free_space = None
+    if prefixes is not None:
+        vnet_subnets = (vnet.subnets or []) if vnet is not None else []
+        free_space = IPRangeSet(prefixes).subtract(p for s in vnet_subnets for p in get_subnet_prefixes(s))
+
+    for subnet in SUBNETS:
+        validate_subnet(cmd, ns, subnet, vnet_parts, prefixes, fetched)
+
+    allocate_subnet_prefixes(cmd, ns, SUBNETS, prefixes, free_space)
+
+    validate_subnet_overlaps(ns, SUBNETS, vnet)
 
     # if vnet address prefix (entered by user or from existing vnet)
     #   should always have something because new vnet requires prefix and existing vnets have one
     # for each subnet that has prefix (after subnet val clears them for existing) validate
 
 
-def validate_subnet(cmd, ns, subnet, vnet_parts, vnet_prefixes):
+def get_subnet_parts(cmd, ns, subnet, vnet_parts):
+    property_val = getattr(ns, f'{subnet}_subnet', None)
+    if none_or_empty(property_val):
+        return None
+    resource_id_parts, _ = _validate_name_or_id(
+        cmd.cli_ctx, vnet_parts['resource_group'], property_val, 'subnets', vnet_parts['name'],
+        'Microsoft.Network/virtualNetworks')
+    return resource_id_parts
+
+
+def validate_subnet(cmd, ns, subnet, vnet_parts, vnet_prefixes, fetched=None):
     property_option = f'--{subnet}-subnet'
     prefix_property_option = f'--{subnet}-subnet-address-prefix'
 
@@ -330,10 +498,8 @@ def validate_subnet(cmd, ns, subnet, vnet_parts, vnet_prefixes):
         raise InvalidArgumentValueError(f'{property_option} must have a value')
 
     vnet_name = vnet_parts['name']
-    vnet_group = vnet_parts['resource_group']
 
-    resource_id_parts, _ = _validate_name_or_id(
-        cmd.cli_ctx, vnet_group, property_val, 'subnets', vnet_name, 'Microsoft.Network/virtualNetworks')
+    resource_id_parts = get_subnet_parts(cmd, ns, subnet, vnet_parts)
 
     subnet_name = resource_id_parts['child_name_1']
 
@@ -354,7 +520,7 @@ def validate_subnet(cmd, ns, subnet, vnet_parts, vnet_prefixes):
     prefix_property_val = getattr(ns, prefix_property_name, None)
     prefix_property_val_default = hasattr(getattr(ns, prefix_property_name), 'is_default')
 
-    existing_subnet = get_subnet(cmd, resource_id_parts)
+    existing_subnet = get_prefetched(cmd, fetched, get_subnet, resource_id_parts)
 
     if existing_subnet is not None:
         logger.info('subnet exists: %s', subnet_name)
@@ -377,16 +543,106 @@ def validate_subnet(cmd, ns, subnet, vnet_parts, vnet_prefixes):
     else:
         setattr(ns, type_property_name, 'new')
         logger.info('subnet does not exist: %s', subnet_name)
-        if vnet_prefixes is not None:
-            vnet_networks = [ipaddress.ip_network(p) for p in vnet_prefixes]
-            if not all(any(h in n for n in vnet_networks) for h in ipaddress.ip_network(
-                    prefix_property_val).hosts()):
-                raise InvalidArgumentValueError(
-                    '{} {} is not within the vnet address space (prefixed: {})'.format(
-                        prefix_property_option, prefix_property_val, ', '.join(vnet_prefixes)))
 
-        if subnet == 'appgateway':
-            validate_private_ip(cmd, ns, prefix_property_val)
+        if prefix_property_val.lower() == AUTO_PREFIX:
+            # allocated by allocate_subnet_prefixes once every explicit prefix is known
+            return
+
+        validate_subnet_prefix(cmd, ns, subnet, vnet_prefixes)
+
+
+def validate_subnet_prefix(cmd, ns, subnet, vnet_prefixes):
+    prefix_property_option = f'--{subnet}-subnet-address-prefix'
+    prefix_property_val = getattr(ns, f'{subnet}_subnet_address_prefix')
+
+    if vnet_prefixes is not None:
+        if not IPRangeSet(vnet_prefixes).contains(prefix_property_val):
+            raise InvalidArgumentValueError(
+                '{} {} is not within the vnet address space (prefixed: {})'.format(
+                    prefix_property_option, prefix_property_val, ', '.join(vnet_prefixes)))
+
+    if subnet == 'appgateway':
+        validate_private_ip(cmd, ns, prefix_property_val)
+
+
+def is_auto_prefix(ns, subnet):
+    prefix = getattr(ns, f'{subnet}_subnet_address_prefix', None)
+    return getattr(ns, f'{subnet}_subnet_type', None) == 'new' and not none_or_empty(prefix) \
+        and prefix.lower() == AUTO_PREFIX
+
+
+def allocate_subnet_prefixes(cmd, ns, subnets, vnet_prefixes, free_space):
+    """ Allocates the new subnets with an 'auto' prefix from the free address space, after removing
+    the explicit (or default) prefixes of the other new subnets, so they can't collide. """
+    auto = [s for s in subnets if is_auto_prefix(ns, s)]
+    if not auto:
+        return
+
+    if free_space is not None:
+        free_space = free_space.subtract(getattr(ns, f'{s}_subnet_address_prefix') for s in subnets
+                                         if getattr(ns, f'{s}_subnet_type', None) == 'new' and s not in auto)
+
+    for subnet in auto:
+        allocate_subnet_prefix(ns, subnet, free_space)
+        validate_subnet_prefix(cmd, ns, subnet, vnet_prefixes)
+
+
+def allocate_subnet_prefix(ns, subnet, free_space):
+    prefix_property_option = f'--{subnet}-subnet-address-prefix'
+    prefix_property_name = f'{subnet}_subnet_address_prefix'
+
+    if free_space is None:
+        raise InvalidArgumentValueError(f'{prefix_property_option} {AUTO_PREFIX} requires a vnet address space')
+
+    prefix_length = AUTO_SUBNET_PREFIX_LENGTHS[subnet]
+    network = free_space.first_fit(prefix_length)
+
+    if network is None:
+        raise InvalidArgumentValueError(
+            f'{prefix_property_option} no free /{prefix_length} address range left in the vnet address space')
+
+    prefix = str(network)
+    free_space.discard(prefix)
+    setattr(ns, prefix_property_name, prefix)
+    logger.warning('Using address prefix %s for %s', prefix, getattr(ns, f'{subnet}_subnet'))
+
+    if subnet == 'appgateway':
+        private_ip_default = hasattr(getattr(ns, 'private_ip_address'), 'is_default')
+        if private_ip_default or none_or_empty(ns.private_ip_address) \
+                or ns.private_ip_address.lower() == AUTO_PREFIX:
+            # .0 - .4 are reserved, use the first usable address
+            ns.private_ip_address = str(network.network_address + 5)
+            logger.warning('Using private ip address %s for the app gateway', ns.private_ip_address)
+
+    return prefix
+
+
+def get_subnet_prefixes(subnet):
+    return subnet.address_prefixes or ([subnet.address_prefix] if subnet.address_prefix else [])
+
+
+def validate_subnet_overlaps(ns, subnets, vnet=None):
+    # the subnets being created can't overlap each other or the subnets already in the vnet
+    vnet_subnets = (vnet.subnets or []) if vnet is not None else []
+    existing = [(p, s.name) for s in vnet_subnets for p in get_subnet_prefixes(s)]
+    taken = IPRangeSet(p for p, _ in existing)
+
+    for subnet in subnets:
+        if getattr(ns, f'{subnet}_subnet_type', None) != 'new':
+            continue
+
+        prefix_property_option = f'--{subnet}-subnet-address-prefix'
+        prefix = getattr(ns, f'{subnet}_subnet_address_prefix')
+
+        if taken.overlaps(prefix):
+            # only look for the subnet we collided with once we know there is one
+            network = ipaddress.ip_network(prefix, strict=False)
+            name = next(n for p, n in existing if network.overlaps(ipaddress.ip_network(p, strict=False)))
+            raise InvalidArgumentValueError(
+                f'{prefix_property_option} {prefix} overlaps with the address prefix of subnet {name}')
+
+        taken.add(prefix)
+        existing.append((prefix, getattr(ns, f'{subnet}_subnet')))
 
 
 def validate_token_lifetime(cmd, ns):  # pylint: disable=unused-argument
@@ -405,19 +661,24 @@ def validate_token_lifetime(cmd, ns):  # pylint: disable=unused-argument
         ns.token_lifetime = f'00:0{lifetime}:00' if lifetime < 10 else f'00:{lifetime}:00'
 
 
-def validate_public_ip(cmd, ns):
+def get_public_ip_parts(cmd, ns):
+    ip_parts, _ = _validate_name_or_id(
+        cmd.cli_ctx, ns.resource_group_name, ns.public_ip_address, 'Microsoft.Network/publicIPAddresses',
+        parent_value=None, parent_type=None)
+    return ip_parts
+
+
+def validate_public_ip(cmd, ns, fetched=None):
 
     if none_or_empty(ns.public_ip_address):
         setattr(ns, 'public_ip_address_type', 'new')
 
     else:
-        ip_parts, _ = _validate_name_or_id(
-            cmd.cli_ctx, ns.resource_group_name, ns.public_ip_address, 'Microsoft.Network/publicIPAddresses',
-            parent_value=None, parent_type=None)
+        ip_parts = get_public_ip_parts(cmd, ns)
 
         ip_name = ip_parts['name']
 
-        ip = get_public_ip(cmd, ip_parts)
+        ip = get_prefetched(cmd, fetched, get_public_ip, ip_parts)
         sub = get_subscription_id(cmd.cli_ctx)
 
         if ip is not None:
@@ -457,6 +718,9 @@ def validate_private_ip(cmd, ns, prefix):  # pylint: disable=unused-argument
     if none_or_empty(ns.private_ip_address) or none_or_empty(prefix):
         raise InvalidArgumentValueError('--private-ip-address and prefix must both have values')
 
+    if ns.private_ip_address.lower() == AUTO_PREFIX:
+        ns.private_ip_address = str(ipaddress.ip_network(prefix).network_address + 5)
+
     private_ip = ipaddress.ip_address(ns.private_ip_address)
 
     if private_ip not in ipaddress.ip_network(prefix):
@@ -484,17 +748,27 @@ def index_version_validator(cmd, ns):  # pylint: disable=unused-argument
             raise InvalidArgumentValueError(
                 '--version/-v should be in format v0.0.0 do not include -pre suffix')
 
-        if not github_release_version_exists(ns.version):
-            raise InvalidArgumentValueError(f'--version/-v {ns.version} does not exist')
+        ns.index_url, immutable = get_release_index_url(version=ns.version)
+
+        try:
+            index = get_index(ns.index_url, immutable=immutable)
+        except IndexNotFoundError as e:
+            raise InvalidArgumentValueError(f'--version/-v {ns.version} does not exist') from e
 
     elif ns.index_url:
         if not _is_valid_url(ns.index_url):
             raise InvalidArgumentValueError(
                 '--index-url should be a valid url')
 
+        index = get_index(ns.index_url)
+
     else:
-        ns.version = ns.version or get_github_latest_release_version(prerelease=ns.prerelease)
-        ns.index_url = f'https://github.com/colbylwilliams/lab-gateway/releases/download/{ns.version}/index.json'
+        ns.index_url, immutable = get_release_index_url(prerelease=ns.prerelease)
+        index = get_index(ns.index_url, immutable=immutable)
+
+    # the index is resolved once here and handed to the command
+    ns.index = parse_release_index(index, ns.version)
+    ns.version = ns.index[0]
 
 
 def _is_valid_url(url):
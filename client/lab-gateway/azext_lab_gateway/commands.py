@@ -4,8 +4,8 @@
 # --------------------------------------------------------------------------------------------
 
 from ._validators import (process_gateway_create_namespace, process_gateway_connect_namespace,
-                          process_gateway_token_namespace, process_gateway_show_namespace)
-#   process_gateway_ip_namespace)
+                          process_gateway_token_namespace, process_gateway_show_namespace,
+                          process_gateway_ip_namespace, process_gateway_ip_check_namespace)
 
 
 def load_command_table(self, _):  # pylint: disable=too-many-statements
@@ -23,6 +23,7 @@ def load_command_table(self, _):  # pylint: disable=too-many-statements
     with self.command_group('lab-gateway token') as g:
         g.custom_show_command('show', 'lab_gateway_token_show', validator=process_gateway_token_namespace)
 
-    # with self.command_group('lab-gateway ip') as g:
-    #     g.custom_command('add', 'lab_gateway_ip_add', validator=process_gateway_ip_namespace)
-    #     g.custom_command('remove', 'lab_gateway_ip_remove', validator=process_gateway_ip_namespace)
+    with self.command_group('lab-gateway ip') as g:
+        g.custom_command('add', 'lab_gateway_ip_add', validator=process_gateway_ip_namespace)
+        g.custom_command('remove', 'lab_gateway_ip_remove', validator=process_gateway_ip_namespace)
+        g.custom_command('check', 'lab_gateway_ip_check', validator=process_gateway_ip_check_namespace)
@@ -5,18 +5,23 @@
 # pylint: disable=unused-argument, too-many-statements, too-many-locals, too-many-lines, consider-using-f-string
 
 import json
-import requests
+import hashlib
 from knack.log import get_logger
-from azure.cli.core.profiles import ResourceType, get_sdk
-from azure.cli.core.commands.client_factory import get_subscription_id
-from ._utils import (get_user_info)
-from ._github_utils import (get_release_index, get_arm_template, get_artifact)
+from knack.util import CLIError
+from ._utils import (get_user_info, get_subscription_id, get_tag_properties)
+from ._github_utils import get_artifact
+from ._template_utils import get_template
+from ._task_utils import (TaskGraph, StepJournal, StaleStepError)
+from ._storage_utils import (get_blob_service_client, get_blob_hashes, copy_artifacts,
+                             upload_blob_if_changed)
 from ._deploy_utils import (get_function_key, get_arm_output, import_certificate,
-                            deploy_arm_template_at_resource_group, tag_resource_group,
-                            get_resource_group_tags, create_subnet, get_azure_rp_ips,
-                            update_api_waf_policy, add_ips_gateway_waf_policy,
-                            remove_ips_gateway_waf_policy)
-from ._constants import TAG_PREFIX, tag_key
+                            deploy_arm_template_at_resource_group, deploy_arm_template_if_changed,
+                            get_succeeded_deployment, get_recorded_deployment, keyvault_secret_exists,
+                            tag_resource_group, get_resource_group_tags, create_subnets, get_azure_rp_ips,
+                            aggregate_azure_rp_ips, pack_match_values, update_api_waf_policy,
+                            add_resource_group_locations, add_ips_gateway_waf_policy,
+                            remove_ips_gateway_waf_policy, check_ips)
+from ._constants import DEPLOY_STAGES, API_WAF_RULE_NAME, tag_key
 
 
 logger = get_logger(__name__)
@@ -30,140 +35,319 @@ def lab_gateway_create(cmd, resource_group_name, admin_username, admin_password,
                        bastion_subnet='AzureBastionSubnet', bastion_subnet_address_prefix='10.0.1.0/27',
                        rdgateway_subnet_type=None, appgateway_subnet_type=None, bastion_subnet_type=None,
                        public_ip_address=None, public_ip_address_type=None, private_ip_address='10.0.2.5',
-                       location=None, tags=None, version=None, prerelease=False, index_url=None):
+                       location=None, tags=None, version=None, prerelease=False, index_url=None, index=None,
+                       force=False, resume=False, stage=None):
 
-    version, _, arm_templates, artifacts = get_release_index(version, prerelease, index_url)
+    version, _, arm_templates, artifacts = index
+
+    sub = get_subscription_id(cmd.cli_ctx)
 
     logger.warning('Deploying%s version: %s', ' prerelease' if prerelease else '', version)
 
     hook = cmd.cli_ctx.get_progress_controller()
     hook.begin()
 
-    a_template = get_arm_template(arm_templates, 'deployA')
-    b_template = get_arm_template(arm_templates, 'deployB')
+    a_template = get_template(arm_templates, 'deployA')
+    # releases that include the stage templates deploy deployB as independent stages
+    staged = all(t in arm_templates for t in DEPLOY_STAGES.values())
 
-    hook.add(message='Getting current user info')
-    user_object_id, user_tenant_id = get_user_info(cmd)
+    artifact_items = [get_artifact(artifacts, i) for i in artifacts]
 
-    # Creating a subnet as a child resource via ARM results in conflicts, and more importantly,
-    # redeploying a template will delete and recreate the subnet, i.e. if the subnet is in use,
-    # the deployments will fail. https://github.com/Azure/bicep/issues/2579
-    # thus for existing vnets we create the missing subnets here vs the ARM template
-    if vnet_type == 'existing':
+    # completed steps are recorded so a failed run can pick up where it stopped with --resume
+    journal = StepJournal(sub, resource_group_name, version)
+    if resume:
+        journal.load()
+    else:
+        journal.clear()
+
+    # each step starts as soon as the steps it requires have finished, so independent steps
+    # (i.e. the graph lookup, subnets, and service tags) overlap the deployments
+    graph = TaskGraph(hook=hook, journal=journal)
+
+    def _get_user_info():
+        return get_user_info(cmd)
+
+    def _create_subnets():
+        # Creating a subnet as a child resource via ARM results in conflicts, and more importantly,
+        # redeploying a template will delete and recreate the subnet, i.e. if the subnet is in use,
+        # the deployments will fail. https://github.com/Azure/bicep/issues/2579
+        # thus for existing vnets we create the missing subnets here vs the ARM template
+        subnets = []
         if rdgateway_subnet_type == 'new':
-            hook.add(message=f'Creating {rdgateway_subnet}')
-            create_subnet(cmd, vnet, rdgateway_subnet, rdgateway_subnet_address_prefix)
+            subnets.append((rdgateway_subnet, rdgateway_subnet_address_prefix))
         if appgateway_subnet_type == 'new':
-            hook.add(message=f'Creating {appgateway_subnet}')
-            create_subnet(cmd, vnet, appgateway_subnet, appgateway_subnet_address_prefix)
+            subnets.append((appgateway_subnet, appgateway_subnet_address_prefix))
         if bastion_subnet_type == 'new':
-            hook.add(message=f'Creating {bastion_subnet}')
-            create_subnet(cmd, vnet, bastion_subnet, bastion_subnet_address_prefix)
-
-    a_params = []
-    a_params.append(f'location={location}')
-    a_params.append(f'resourcePrefix={resource_prefix}')
-    a_params.append(f'userId={user_object_id}')
-    a_params.append(f'tenantId={user_tenant_id}')
-    a_params.append(f'tags={json.dumps(tags)}')
-
-    # deployA template creates a keyvault, storage account, and log analytics workspace
-    hook.add(message='Creating keyvault and storage account')
-    _, a_outputs = deploy_arm_template_at_resource_group(cmd, resource_group_name, template_uri=a_template,
-                                                         parameters=[a_params])
-
-    keyvault_name = get_arm_output(a_outputs, 'keyvaultName')
-    storage_connection_string = get_arm_output(a_outputs, 'storageConnectionString')
-    storage_artifacts_container = get_arm_output(a_outputs, 'artifactsContainerName')
-
-    cert_name = 'SSLCertificate'
-    # import the ssl cert required by the application gateway and vmwss
-    hook.add(message='Importing SSL certificate to keyvault')
-    _, cert_cn, cert_secret_url = import_certificate(cmd, keyvault_name, cert_name, ssl_cert,
-                                                     password=ssl_cert_password)
-
-    artifact_items = [get_artifact(artifacts, i) for i in artifacts]
-
-    BlobServiceClient = get_sdk(cmd.cli_ctx, ResourceType.DATA_STORAGE_BLOB,
-                                '_blob_service_client#BlobServiceClient')
-    blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
-
-    # upload the artifacts from the github repo
-    for artifact_name, artifact_url in artifact_items:
-        hook.add(message=f'Uploading {artifact_name} to storage')
-        blob_client = blob_service_client.get_blob_client(storage_artifacts_container, artifact_name)
-        blob_exists = blob_client.exists()
-        if not blob_exists:
-            response = requests.get(artifact_url)
-            blob_client.upload_blob(response.content)
-
-    # upload the RDGatewayFedAuth file
-    hook.add(message='Uploading RDGatewayFedAuth.msi to storage')
-    blob_client = blob_service_client.get_blob_client(storage_artifacts_container, 'RDGatewayFedAuth.msi')
-    blob_exists = blob_client.exists()
-    if not blob_exists:
-        blob_client.upload_blob(auth_msi)
-
-    b_params = []
-    b_params.append(f'location={location}')
-    b_params.append(f'resourcePrefix={resource_prefix}')
-    b_params.append(f'adminUsername={admin_username}')
-    b_params.append(f'adminPassword={admin_password}')
-    b_params.append(f'tokenLifetime={token_lifetime}')
-    b_params.append(f'hostName={cert_cn}')
-    b_params.append(f'sslCertificateSecretUri={cert_secret_url}')
-    b_params.append('vnet={}'.format('' if vnet is None else vnet))
-    b_params.append('publicIPAddress={}'.format('' if public_ip_address is None else public_ip_address))
-    b_params.append('tokenPrivateEndpoint={}'.format('false'))
-    b_params.append(f'instanceCount={instance_count}')
-    b_params.append('vnetAddressPrefixes={}'.format(json.dumps([vnet_address_prefix])))
-
-    b_params.append(f'gatewaySubnetName={rdgateway_subnet}')
-    if rdgateway_subnet_address_prefix is not None:
-        b_params.append(f'gatewaySubnetAddressPrefix={rdgateway_subnet_address_prefix}')
-
-    if bastion_subnet_address_prefix is not None:
-        b_params.append(f'bastionSubnetAddressPrefix={bastion_subnet_address_prefix}')
-
-    b_params.append(f'appGatewaySubnetName={appgateway_subnet}')
-    if appgateway_subnet_address_prefix is not None:
-        b_params.append(f'appGatewaySubnetAddressPrefix={appgateway_subnet_address_prefix}')
-
-    b_params.append('privateIPAddress={}'.format('' if private_ip_address is None else private_ip_address))
-
-    hook.add(message='Getting Azure Cloud Resource Provider IPs')
-    azure_rp_ips = get_azure_rp_ips(cmd, location)
-    b_params.append('azureResourceProviderIps={}'.format(json.dumps(azure_rp_ips)))
-
-    b_params.append('tags={}'.format(json.dumps(tags)))
-
-    # deployB template creates a the rest of the solution
-    hook.add(message='Deploying solution')
-    _, b_outputs = deploy_arm_template_at_resource_group(cmd, resource_group_name, template_uri=b_template,
-                                                         parameters=[b_params])
-
-    function_name = get_arm_output(b_outputs, 'functionName')
-    public_ip = get_arm_output(b_outputs, 'publicIpAddress')
-    vnet_id = get_arm_output(b_outputs, 'vnetId')
-
-    # create the function key for the CreatToken function if it does not exist
-    hook.add(message='Generating auth token')
-    _ = get_function_key(cmd, resource_group_name, function_name, 'CreateToken', 'gateway')
-
-    tags.update({tag_key('creator'): user_object_id})
-    tags.update({tag_key('hostname'): cert_cn})
-    tags.update({tag_key('function'): function_name})
-    tags.update({tag_key('publicIp'): public_ip})
-    tags.update({tag_key('vnet'): vnet_id})
-    tags.update({tag_key('privateIp'): f'{private_ip_address}'})
-    tags.update({tag_key('prefix'): f'{resource_prefix}'})
-    tags.update({tag_key('locations'): json.dumps(['{}'.format(location.lower().replace(' ', ''))])})
-
-    # apply the tags at the resource group level
-    hook.add(message='Tagging resource group')
-    _ = tag_resource_group(cmd, resource_group_name, tags)
-
-    sub = get_subscription_id(cmd.cli_ctx)
+            subnets.append((bastion_subnet, bastion_subnet_address_prefix))
+        # subnet updates on a vnet are serialized, so add them all in one vnet update
+        if subnets:
+            create_subnets(cmd, vnet, subnets, progress=graph.report)
+
+    def _deploy_a(user_info):
+        user_object_id, user_tenant_id = user_info
+
+        a_params = []
+        a_params.append(f'location={location}')
+        a_params.append(f'resourcePrefix={resource_prefix}')
+        a_params.append(f'userId={user_object_id}')
+        a_params.append(f'tenantId={user_tenant_id}')
+        a_params.append(f'tags={json.dumps(tags)}')
+
+        # deployA template creates a keyvault, storage account, and log analytics workspace
+        a_deployment, a_outputs = deploy_arm_template_if_changed(cmd, resource_group_name, 'deployA', a_template,
+                                                                 parameters=[a_params], force=force,
+                                                                 progress=graph.report)
+        return a_deployment.name, a_outputs
+
+    def _import_certificate(a_deployment):
+        _, a_outputs = a_deployment
+        keyvault_name = get_arm_output(a_outputs, 'keyvaultName')
+        cert_name = 'SSLCertificate'
+        # import the ssl cert required by the application gateway and vmwss
+        _, cert_cn, cert_secret_url = import_certificate(cmd, keyvault_name, cert_name, ssl_cert,
+                                                         password=ssl_cert_password)
+        return cert_cn, cert_secret_url
+
+    def _upload_artifacts(a_deployment):
+        _, a_outputs = a_deployment
+        storage_connection_string = get_arm_output(a_outputs, 'storageConnectionString')
+        storage_artifacts_container = get_arm_output(a_outputs, 'artifactsContainerName')
+
+        blob_service_client = get_blob_service_client(cmd, storage_connection_string)
+
+        # blobs are only replaced when their content hash differs from the one we expect
+        blob_hashes = get_blob_hashes(blob_service_client, storage_artifacts_container)
+
+        # copy the artifacts from the github release server-side
+        copy_artifacts(blob_service_client, storage_artifacts_container, artifact_items, blob_hashes)
+
+        # upload the RDGatewayFedAuth file
+        upload_blob_if_changed(blob_service_client, storage_artifacts_container, 'RDGatewayFedAuth.msi',
+                               auth_msi, blob_hashes)
+
+    def _get_azure_rp_ips():
+        # packed into the match conditions of the api waf rule, this fails early if they don't fit in one rule
+        return pack_match_values(aggregate_azure_rp_ips(get_azure_rp_ips(cmd, location)), API_WAF_RULE_NAME)
+
+    def _deploy_b(cert, azure_rp_ips, *_):
+        cert_cn, cert_secret_url = cert
+
+        b_params = []
+        b_params.append(f'location={location}')
+        b_params.append(f'resourcePrefix={resource_prefix}')
+        b_params.append(f'adminUsername={admin_username}')
+        b_params.append(f'adminPassword={admin_password}')
+        b_params.append(f'tokenLifetime={token_lifetime}')
+        b_params.append(f'hostName={cert_cn}')
+        b_params.append(f'sslCertificateSecretUri={cert_secret_url}')
+        b_params.append('vnet={}'.format('' if vnet is None else vnet))
+        b_params.append('publicIPAddress={}'.format('' if public_ip_address is None else public_ip_address))
+        b_params.append('tokenPrivateEndpoint={}'.format('false'))
+        b_params.append(f'instanceCount={instance_count}')
+        b_params.append('vnetAddressPrefixes={}'.format(json.dumps([vnet_address_prefix])))
+
+        b_params.append(f'gatewaySubnetName={rdgateway_subnet}')
+        b_params.append(f'appGatewaySubnetName={appgateway_subnet}')
+        b_params.extend(_get_subnet_prefix_params())
+
+        b_params.append('privateIPAddress={}'.format('' if private_ip_address is None else private_ip_address))
+
+        # the template creates one match condition per list
+        b_params.append('azureResourceProviderIps={}'.format(json.dumps(azure_rp_ips)))
+
+        b_params.append('tags={}'.format(json.dumps(tags)))
+
+        # deployB template creates a the rest of the solution
+        b_template = get_template(arm_templates, 'deployB')
+        b_deployment, b_outputs = deploy_arm_template_if_changed(cmd, resource_group_name, 'deployB', b_template,
+                                                                 parameters=[b_params], extra=_get_artifact_hashes(),
+                                                                 force=force, progress=graph.report)
+        return b_deployment.name, b_outputs
+
+    def _get_subnet_prefix_params():
+        # the prefixes of existing subnets are None, the template only uses them for a new vnet
+        return ['{}={}'.format(k, '' if v is None else v) for k, v in [
+            ('gatewaySubnetAddressPrefix', rdgateway_subnet_address_prefix),
+            ('bastionSubnetAddressPrefix', bastion_subnet_address_prefix),
+            ('appGatewaySubnetAddressPrefix', appgateway_subnet_address_prefix)]]
+
+    def _get_artifact_hashes():
+        # the vms install the artifacts, so they have to be redeployed when the artifacts change
+        artifact_hashes = {i[0]: i[2] for i in artifact_items}
+        artifact_hashes['RDGatewayFedAuth.msi'] = hashlib.sha256(auth_msi).hexdigest()
+        return artifact_hashes
+
+    def _deploy_stage(stage_name, params, extra=None):
+        name = DEPLOY_STAGES[stage_name]
+        if stage is not None and stage != stage_name:
+            # only the requested stage is deployed, the others pass on the outputs of their last deployment
+            deployment = get_recorded_deployment(cmd, resource_group_name, name)
+            if deployment is None:
+                raise CLIError(f'Stage {stage_name} has not been deployed, run create without --stage first')
+            return deployment.name, deployment.properties.outputs
+
+        params = [f'location={location}', f'resourcePrefix={resource_prefix}'] + params
+        params.append('tags={}'.format(json.dumps(tags)))
+
+        deployment, outputs = deploy_arm_template_if_changed(cmd, resource_group_name, name,
+                                                             get_template(arm_templates, name),
+                                                             parameters=[params], extra=extra,
+                                                             force=force or stage == stage_name,
+                                                             progress=graph.report)
+        return deployment.name, outputs
+
+    def _deploy_core(cert):
+        cert_cn, _ = cert
+        return _deploy_stage('core', [f'hostName={cert_cn}'])
+
+    def _deploy_network(*_):
+        params = []
+        params.append('vnet={}'.format('' if vnet is None else vnet))
+        params.append('vnetAddressPrefixes={}'.format(json.dumps([vnet_address_prefix])))
+        params.append(f'gatewaySubnetName={rdgateway_subnet}')
+        params.append(f'appGatewaySubnetName={appgateway_subnet}')
+        params.extend(_get_subnet_prefix_params())
+        return _deploy_stage('network', params)
+
+    def _deploy_function(core):
+        _, core_outputs = core
+        params = []
+        params.append('keyVaultName={}'.format(get_arm_output(core_outputs, 'keyVaultName')))
+        params.append(f'tokenLifetime={token_lifetime}')
+        params.append('storageAccountName={}'.format(get_arm_output(core_outputs, 'storageAccountName')))
+        params.append('signCertificateSecretUri={}'.format(get_arm_output(core_outputs, 'signCertificateSecretUri')))
+        params.append('logAnalyticsWorkspaceId={}'.format(get_arm_output(core_outputs, 'logAnalyticsWorkspaceId')))
+        return _deploy_stage('function', params)
+
+    def _deploy_bastion(network):
+        _, network_outputs = network
+        return _deploy_stage('bastion', ['bastionSubnet={}'.format(get_arm_output(network_outputs, 'bastionSubnet'))])
+
+    def _deploy_gateway(cert, azure_rp_ips, core, network, function):
+        cert_cn, cert_secret_url = cert
+        _, core_outputs = core
+        _, network_outputs = network
+        _, function_outputs = function
+        params = []
+        params.append(f'hostName={cert_cn}')
+        params.append('keyVaultName={}'.format(get_arm_output(core_outputs, 'keyVaultName')))
+        params.append(f'sslCertificateSecretUri={cert_secret_url}')
+        params.append('functionHostName={}'.format(get_arm_output(function_outputs, 'functionHostName')))
+        params.append('appGatewaySubnet={}'.format(get_arm_output(network_outputs, 'appGatewaySubnet')))
+        params.append('publicIPAddress={}'.format('' if public_ip_address is None else public_ip_address))
+        params.append('privateIPAddress={}'.format('' if private_ip_address is None else private_ip_address))
+        params.append('logAnalyticsWorkspaceId={}'.format(get_arm_output(core_outputs, 'logAnalyticsWorkspaceId')))
+        # the template creates one match condition per list
+        params.append('azureResourceProviderIps={}'.format(json.dumps(azure_rp_ips)))
+        return _deploy_stage('gateway', params)
+
+    def _deploy_vmss(cert, core, network, function, gateway, *_):
+        _, cert_secret_url = cert
+        _, core_outputs = core
+        _, network_outputs = network
+        _, function_outputs = function
+        _, gateway_outputs = gateway
+        params = []
+        params.append(f'adminUsername={admin_username}')
+        params.append(f'adminPassword={admin_password}')
+        params.append(f'instanceCount={instance_count}')
+        params.append('keyVaultName={}'.format(get_arm_output(core_outputs, 'keyVaultName')))
+        params.append(f'sslCertificateSecretUri={cert_secret_url}')
+        params.append('signCertificateSecretUri={}'.format(get_arm_output(core_outputs, 'signCertificateSecretUri')))
+        params.append('storageAccountName={}'.format(get_arm_output(core_outputs, 'storageAccountName')))
+        params.append('storageArtifactsEndpoint={}'.format(get_arm_output(core_outputs, 'storageArtifactsEndpoint')))
+        params.append('functionHostName={}'.format(get_arm_output(function_outputs, 'functionHostName')))
+        params.append('gatewaySubnet={}'.format(get_arm_output(network_outputs, 'gatewaySubnet')))
+        params.append('backendAddressPools={}'.format(
+            json.dumps(get_arm_output(gateway_outputs, 'backendAddressPools'))))
+        return _deploy_stage('vmss', params, extra=_get_artifact_hashes())
+
+    def _join_stages(network, function, gateway, vmss, *_):
+        # collects the stage outputs in the shape of the deployB outputs, so the steps after it don't change
+        outputs = {}
+        outputs['vnetId'] = {'value': get_arm_output(network[1], 'vnetId')}
+        outputs['functionName'] = {'value': get_arm_output(function[1], 'functionName')}
+        outputs['publicIpAddress'] = {'value': get_arm_output(gateway[1], 'publicIpAddress')}
+        outputs['scaleSetName'] = {'value': get_arm_output(vmss[1], 'scaleSetName')}
+        return None, outputs
+
+    def _load_deployment(deployment_name):
+        # only the deployment name is recorded, the outputs include secrets
+        deployment = get_succeeded_deployment(cmd, resource_group_name, deployment_name)
+        if deployment is None:
+            raise StaleStepError(f'deployment {deployment_name} no longer exists')
+        return deployment.name, deployment.properties.outputs
+
+    def _load_certificate(cert):
+        cert_cn, cert_secret_url = cert
+        if not keyvault_secret_exists(cmd, cert_secret_url):
+            raise StaleStepError(f'certificate {cert_secret_url} no longer exists')
+        return cert_cn, cert_secret_url
+
+    def _get_function_key(b_deployment):
+        _, b_outputs = b_deployment
+        function_name = get_arm_output(b_outputs, 'functionName')
+        # create the function key for the CreatToken function if it does not exist
+        return get_function_key(cmd, resource_group_name, function_name, 'CreateToken', 'gateway')
+
+    def _tag_resource_group(user_info, cert, b_deployment, *_):
+        user_object_id, _ = user_info
+        _, b_outputs = b_deployment
+        cert_cn, _ = cert
+
+        tags.update({tag_key('creator'): user_object_id})
+        tags.update({tag_key('hostname'): cert_cn})
+        tags.update({tag_key('function'): get_arm_output(b_outputs, 'functionName')})
+        tags.update({tag_key('publicIp'): get_arm_output(b_outputs, 'publicIpAddress')})
+        tags.update({tag_key('vnet'): get_arm_output(b_outputs, 'vnetId')})
+        tags.update({tag_key('privateIp'): f'{private_ip_address}'})
+        tags.update({tag_key('prefix'): f'{resource_prefix}'})
+        tags.update({tag_key('locations'): json.dumps(['{}'.format(location.lower().replace(' ', ''))])})
+
+        # apply the tags at the resource group level
+        return tag_resource_group(cmd, resource_group_name, tags)
+
+    b_requires = ['cert', 'rp_ips', 'upload']
+    network_requires = []
+
+    graph.add('user', _get_user_info, message='Getting current user info', load=tuple)
+    if vnet_type == 'existing':
+        b_requires.append(graph.add('subnets', _create_subnets, message='Creating subnets'))
+        network_requires.append('subnets')
+    graph.add('rp_ips', _get_azure_rp_ips, message='Getting Azure Cloud Resource Provider IPs')
+    graph.add('deploy_a', _deploy_a, requires=['user'], message='Creating keyvault and storage account',
+              save=lambda d: d[0], load=_load_deployment)
+    graph.add('cert', _import_certificate, requires=['deploy_a'], message='Importing SSL certificate to keyvault',
+              load=_load_certificate)
+    graph.add('upload', _upload_artifacts, requires=['deploy_a'], message='Copying artifacts to storage')
+    if staged:
+        # each stage starts as soon as the outputs it needs exist, i.e. the network and bastion
+        # deploy alongside deployA, and a stage whose inputs are unchanged is skipped on its own
+        graph.add('core', _deploy_core, requires=['cert'], message='Deploying core resources',
+                  save=lambda d: d[0], load=_load_deployment)
+        graph.add('network', _deploy_network, requires=network_requires, message='Deploying network',
+                  save=lambda d: d[0], load=_load_deployment)
+        graph.add('function', _deploy_function, requires=['core'], message='Deploying function app',
+                  save=lambda d: d[0], load=_load_deployment)
+        graph.add('bastion', _deploy_bastion, requires=['network'], message='Deploying bastion',
+                  save=lambda d: d[0], load=_load_deployment)
+        graph.add('gateway', _deploy_gateway, requires=['cert', 'rp_ips', 'core', 'network', 'function'],
+                  message='Deploying application gateway', save=lambda d: d[0], load=_load_deployment)
+        graph.add('vmss', _deploy_vmss, requires=['cert', 'core', 'network', 'function', 'gateway', 'upload'],
+                  message='Deploying gateway scale set', save=lambda d: d[0], load=_load_deployment)
+        graph.add('deploy_b', _join_stages, requires=['network', 'function', 'gateway', 'vmss', 'bastion'])
+    else:
+        graph.add('deploy_b', _deploy_b, requires=b_requires, message='Deploying solution',
+                  save=lambda d: d[0], load=_load_deployment)
+    graph.add('function_key', _get_function_key, requires=['deploy_b'], message='Generating auth token')
+    graph.add('tags', _tag_resource_group, requires=['user', 'cert', 'deploy_b', 'function_key'],
+              message='Tagging resource group')
+
+    results = graph.run()
+    journal.clear()
+
+    cert_cn, _ = results['cert']
+    public_ip = get_arm_output(results['deploy_b'][1], 'publicIpAddress')
 
     hook.end(message=' ')
     logger.warning(' ')
@@ -178,9 +362,7 @@ def lab_gateway_create(cmd, resource_group_name, admin_username, admin_password,
     result.update({'subscription': sub})
     result.update({'resourceGroup': f'{resource_group_name}'})
 
-    for k in tags:
-        if k.startswith(TAG_PREFIX):
-            result.update({k.split(':')[1]: tags.get(k, None)})
+    result.update(get_tag_properties(tags))
 
     return result
 
@@ -195,18 +377,16 @@ def lab_gateway_show(cmd, resource_group_name, resource_prefix):
     result.update({'subscription': sub})
     result.update({'resourceGroup': resource_group_name})
 
-    for k in tags:
-        if k.startswith(TAG_PREFIX):
-            result.update({k.split(':')[1]: tags.get(k, None)})
+    result.update(get_tag_properties(tags))
 
     return result
 
 
 def lab_gateway_lab_connect(cmd, resource_group_name, lab_name, gateway_resource_group_name, resource_prefix,
                             lab_location=None, gateway_function_name=None, gateway_hostname=None,
-                            gateway_locations=None, version=None, prerelease=False, index_url=None):
+                            gateway_locations=None, version=None, prerelease=False, index_url=None, index=None):
 
-    version, _, arm_templates, _ = get_release_index(version, prerelease, index_url)
+    version, _, arm_templates, _ = index
 
     logger.warning('Connecting lab using%s version: %s', ' prerelease' if prerelease else '', version)
 
@@ -226,21 +406,24 @@ def lab_gateway_lab_connect(cmd, resource_group_name, lab_name, gateway_resource
     hook = cmd.cli_ctx.get_progress_controller()
     hook.begin()
 
-    template = get_arm_template(arm_templates, 'connect')
+    template = get_template(arm_templates, 'connect')
 
     hook.add(message='Getting gateway auth token')
     token = get_function_key(cmd, gateway_resource_group_name, gateway_function_name, 'CreateToken', 'gateway')
 
+    allow_list = None
     if lab_location not in gateway_locations:
+        # other labs may be connecting at the same time, so both the allow list and the tag
+        # are merged with their current values rather than overwritten
         hook.add(message=f'Adding {lab_location} Azure region IP addresses to gateway allow list')
-        gateway_locations.append(lab_location)
-        _ = update_api_waf_policy(cmd, resource_prefix, gateway_resource_group_name, gateway_locations)
+        allow_list = update_api_waf_policy(cmd, resource_prefix, gateway_resource_group_name,
+                                           gateway_locations + [lab_location], merge=True)
+        hook.add(message='Gateway allow list: {} prefixes added, {} prefixes removed'.format(
+            len(allow_list['added']), len(allow_list['removed'])))
 
-    tags = {}
-    tags.update({tag_key('locations'): json.dumps(gateway_locations)})
-
-    hook.add(message='Updating gateway resource group tags')
-    _ = tag_resource_group(cmd, gateway_resource_group_name, tags)
+        # the location is only recorded once its ips are allowed, a failed update is retried by the next connect
+        hook.add(message='Updating gateway resource group tags')
+        gateway_locations = add_resource_group_locations(cmd, gateway_resource_group_name, [lab_location])
 
     params = []
     params.append(f'labName={lab_name}')
@@ -249,8 +432,8 @@ def lab_gateway_lab_connect(cmd, resource_group_name, lab_name, gateway_resource
     params.append(f'gatewayToken={token}')
 
     hook.add(message='Adding gateway settings to lab')
-    result, _ = deploy_arm_template_at_resource_group(cmd, resource_group_name, template_uri=template,
-                                                      parameters=[params])
+    result, _ = deploy_arm_template_at_resource_group(cmd, resource_group_name, template=template, parameters=[params],
+                                                      progress=lambda m: hook.add(message=m), template_name='connect')
     hook.end(message=' ')
     logger.warning(' ')
 
@@ -262,6 +445,8 @@ def lab_gateway_lab_connect(cmd, resource_group_name, lab_name, gateway_resource
     result.update({'labResourceGroup': resource_group_name})
     result.update({'gatewayHostname': gateway_hostname})
     result.update({'gatewayResourceGroup': gateway_resource_group_name})
+    if allow_list is not None:
+        result.update({'allowList': allow_list})
 
     return result
 
@@ -270,11 +455,15 @@ def lab_gateway_token_show(cmd, resource_group_name, resource_prefix, gateway_fu
     return get_function_key(cmd, resource_group_name, gateway_function_name, 'CreateToken', 'gateway')
 
 
-def lab_gateway_ip_add(cmd, resource_group_name, resource_prefix, ips):
+def lab_gateway_ip_add(cmd, resource_group_name, resource_prefix, ips=None, ips_file=None):
     ips = add_ips_gateway_waf_policy(cmd, resource_prefix, resource_group_name, ips)
     return ips
 
 
-def lab_gateway_ip_remove(cmd, resource_group_name, resource_prefix, ips):
+def lab_gateway_ip_remove(cmd, resource_group_name, resource_prefix, ips=None, ips_file=None):
     ips = remove_ips_gateway_waf_policy(cmd, resource_prefix, resource_group_name, ips)
     return ips
+
+
+def lab_gateway_ip_check(cmd, resource_group_name, resource_prefix, ips=None, ips_file=None):
+    return check_ips(cmd, resource_prefix, resource_group_name, ips)
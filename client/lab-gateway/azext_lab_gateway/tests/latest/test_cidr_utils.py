@@ -0,0 +1,198 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import random
+import ipaddress
+import unittest
+from time import perf_counter
+from unittest import mock
+
+from azext_lab_gateway import _cidr_utils
+from azext_lab_gateway._cidr_utils import (IPRangeSet, IPPrefixIndex, aggregate_prefixes, merge_ranges, to_range)
+
+# large enough to take the numpy path, roughly the size of the AzureCloud service tags
+LARGE_PREFIX_COUNT = 20000
+
+
+def random_prefixes(rng, count, version=4, min_length=16, max_length=32, base=None):
+    """ Returns count random, strictly valid prefixes, optionally inside the base network. """
+    base = base or (ipaddress.ip_network('0.0.0.0/0') if version == 4 else ipaddress.ip_network('2001:db8::/32'))
+    max_bits = base.max_prefixlen
+    prefixes = []
+    for _ in range(count):
+        length = rng.randint(max(min_length, base.prefixlen), max_length)
+        address = int(base.network_address) + rng.getrandbits(max_bits - base.prefixlen)
+        network = ipaddress.ip_network((address, length), strict=False)
+        prefixes.append(str(network))
+    return prefixes
+
+
+def addresses(prefixes):
+    """ The set of integer addresses covered by prefixes, only usable for small networks. """
+    result = set()
+    for prefix in prefixes:
+        start, end = to_range(prefix)
+        result.update(range(start, end + 1))
+    return result
+
+
+class IPRangeSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(1234)
+        self.base = ipaddress.ip_network('10.0.0.0/20')
+
+    def test_collapse_matches_ipaddress(self):
+        for _ in range(20):
+            prefixes = random_prefixes(self.rng, 200, min_length=8, max_length=30)
+            expected = [str(n) for n in ipaddress.collapse_addresses(ipaddress.ip_network(p) for p in prefixes)]
+            self.assertEqual(aggregate_prefixes(prefixes), expected)
+
+    def test_collapse_matches_ipaddress_v6(self):
+        prefixes = random_prefixes(self.rng, 500, version=6, min_length=40, max_length=64)
+        expected = [str(n) for n in ipaddress.collapse_addresses(ipaddress.ip_network(p) for p in prefixes)]
+        self.assertEqual(aggregate_prefixes(prefixes), expected)
+
+    def test_mixed_families_stay_apart(self):
+        prefixes = ['10.0.0.0/24', '10.0.1.0/24', '2001:db8::/64', '2001:db8:0:1::/64']
+        self.assertEqual(aggregate_prefixes(prefixes), ['10.0.0.0/23', '2001:db8::/63'])
+
+    def test_subtract(self):
+        for _ in range(50):
+            left = random_prefixes(self.rng, 10, min_length=22, max_length=32, base=self.base)
+            right = random_prefixes(self.rng, 10, min_length=22, max_length=32, base=self.base)
+            result = IPRangeSet(left).subtract(right)
+            self.assertEqual(addresses(result.to_prefixes()), addresses(left) - addresses(right))
+
+    def test_subtract_everything(self):
+        self.assertFalse(IPRangeSet(['10.0.0.0/24']).subtract(['10.0.0.0/16']))
+
+    def test_contains_and_overlaps(self):
+        range_set = IPRangeSet(['10.0.0.0/24', '10.0.2.0/24'])
+        self.assertTrue(range_set.contains('10.0.0.5'))
+        self.assertTrue(range_set.contains('10.0.0.128/25'))
+        self.assertFalse(range_set.contains('10.0.0.0/22'))
+        self.assertTrue(range_set.overlaps('10.0.0.0/22'))
+        self.assertFalse(range_set.overlaps('10.0.1.0/24'))
+
+    def test_strict_rejects_host_bits(self):
+        with self.assertRaises(ValueError):
+            IPRangeSet(['203.0.113.5/24'], strict=True)
+        self.assertEqual(IPRangeSet(['203.0.113.5/24']).to_prefixes(), ['203.0.113.0/24'])
+
+    def test_first_fit(self):
+        free = IPRangeSet(['10.0.0.0/16']).subtract(['10.0.0.0/24', '10.0.1.0/27'])
+        self.assertEqual(str(free.first_fit(27)), '10.0.1.32/27')
+        self.assertEqual(str(free.first_fit(24)), '10.0.2.0/24')
+        self.assertIsNone(IPRangeSet(['10.0.0.0/28']).first_fit(27))
+
+
+@unittest.skipIf(_cidr_utils.numpy is None, 'numpy is not installed')
+class MergeRangesNumpyTest(unittest.TestCase):
+
+    def test_numpy_matches_pure_python(self):
+        rng = random.Random(42)
+        ranges = [to_range(p) for p in random_prefixes(rng, LARGE_PREFIX_COUNT, min_length=12)]
+        with mock.patch.object(_cidr_utils, 'numpy', None):
+            expected = merge_ranges(ranges)
+        self.assertEqual(merge_ranges(ranges), expected)
+
+    def test_adjacent_ranges_merge(self):
+        ranges = [(i * 256, i * 256 + 255) for i in range(_cidr_utils.NUMPY_MIN_RANGES)]
+        self.assertEqual(merge_ranges(ranges), [(0, _cidr_utils.NUMPY_MIN_RANGES * 256 - 1)])
+
+
+class IPPrefixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(99)
+
+    def _brute_force(self, items, address):
+        point = to_range(address)[0]
+        # the outermost containing prefix is kept, nested ones are dropped
+        found = [(to_range(p), p, label) for p, label in items if to_range(p)[0] <= point <= to_range(p)[1]]
+        if not found:
+            return None
+        _, prefix, label = min(found, key=lambda f: (f[0][0], -f[0][1]))
+        return prefix, label
+
+    def test_lookup(self):
+        items = [('10.0.0.0/8', 'a'), ('10.1.0.0/16', 'b'), ('192.168.0.0/24', 'c'), ('2001:db8::/32', 'd')]
+        index = IPPrefixIndex(items)
+        self.assertEqual(index.lookup('10.1.2.3'), ('10.0.0.0/8', 'a'))
+        self.assertEqual(index.lookup('192.168.0.255'), ('192.168.0.0/24', 'c'))
+        self.assertEqual(index.lookup('2001:db8::1'), ('2001:db8::/32', 'd'))
+        self.assertIsNone(index.lookup('172.16.0.1'))
+
+    def test_lookup_matches_brute_force(self):
+        items = [(p, f'rule-{i % 3}') for i, p in enumerate(random_prefixes(self.rng, 300, min_length=8))]
+        index = IPPrefixIndex(items)
+        points = [str(ipaddress.IPv4Address(self.rng.getrandbits(32))) for _ in range(500)]
+        # addresses inside the prefixes too, random points rarely hit anything
+        points += [p.split('/', 1)[0] for p, _ in items]
+        for point, match in zip(points, index.lookup_many(points)):
+            self.assertEqual(match, self._brute_force(items, point))
+
+    @unittest.skipIf(_cidr_utils.numpy is None, 'numpy is not installed')
+    def test_numpy_lookup_matches_bisect(self):
+        items = [(p, 'rule') for p in random_prefixes(self.rng, 2000, min_length=10)]
+        index = IPPrefixIndex(items)
+        points = [str(ipaddress.IPv4Address(self.rng.getrandbits(32))) for _ in range(_cidr_utils.NUMPY_MIN_RANGES * 2)]
+        points += [p.split('/', 1)[0] for p, _ in items]
+        with mock.patch.object(_cidr_utils, 'numpy', None):
+            expected = index.lookup_many(points)
+        self.assertEqual(index.lookup_many(points), expected)
+
+
+class CidrBenchmarkTest(unittest.TestCase):
+    """ Times the interval set against the standard library on a large prefix set. The assertions only
+    check the results agree, the timings are printed for comparison (pytest -s). """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(7)
+        cls.prefixes = random_prefixes(rng, LARGE_PREFIX_COUNT, min_length=12)
+        cls.others = random_prefixes(rng, LARGE_PREFIX_COUNT, min_length=12)
+
+    def _time(self, name, func):
+        start = perf_counter()
+        result = func()
+        print(f'{name}: {(perf_counter() - start) * 1000:.1f} ms')
+        return result
+
+    def test_benchmark_collapse(self):
+        networks = [ipaddress.ip_network(p) for p in self.prefixes]
+        expected = self._time('ipaddress.collapse_addresses', lambda: list(ipaddress.collapse_addresses(networks)))
+        result = self._time('aggregate_prefixes', lambda: aggregate_prefixes(self.prefixes))
+        self.assertEqual(result, [str(n) for n in expected])
+
+    def test_benchmark_merge(self):
+        ranges = [to_range(p) for p in self.prefixes]
+        with mock.patch.object(_cidr_utils, 'numpy', None):
+            expected = self._time('merge_ranges (python)', lambda: merge_ranges(ranges))
+        result = self._time('merge_ranges', lambda: merge_ranges(ranges))
+        self.assertEqual(result, expected)
+
+    def test_benchmark_subtract(self):
+        left, right = IPRangeSet(self.prefixes), IPRangeSet(self.others)
+        result = self._time('IPRangeSet.subtract', lambda: left.subtract(right))
+        # nothing left over overlaps what was subtracted, and everything left over was in the left set
+        self.assertFalse(result.subtract(left))
+        self.assertEqual(result.union(right), left.union(right))
+        for start, end in list(result)[:1000]:
+            self.assertFalse(right.overlaps(ipaddress.ip_network(str(ipaddress.IPv4Address(start)))))
+            self.assertFalse(right.overlaps(ipaddress.ip_network(str(ipaddress.IPv4Address(end)))))
+
+    def test_benchmark_lookup(self):
+        rng = random.Random(3)
+        index = IPPrefixIndex((p, 'rule') for p in self.prefixes)
+        points = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(LARGE_PREFIX_COUNT)]
+        result = self._time('IPPrefixIndex.lookup_many', lambda: index.lookup_many(points))
+        range_set = IPRangeSet(self.prefixes)
+        self.assertEqual([m is not None for m in result], [range_set.contains(p) for p in points])
+
+
+if __name__ == '__main__':
+    unittest.main()
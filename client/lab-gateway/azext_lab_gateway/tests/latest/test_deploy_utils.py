@@ -0,0 +1,333 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import json
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from knack.util import CLIError
+from azure.core.exceptions import HttpResponseError
+from azure.cli.core.azclierror import InvalidTemplateError
+
+from azext_lab_gateway import _deploy_utils
+from azext_lab_gateway._constants import RESOURCE_GROUP_MAX_TAGS, GATEWAY_WAF_RULE_NAME, tag_key
+from azext_lab_gateway._deploy_utils import (add_resource_group_locations, remove_ips_gateway_waf_policy,
+                                             get_ip_rule_values, watch_deployment, DeploymentFailedError,
+                                             pack_match_values, set_ip_rules, diff_ip_values, update_ip_rules,
+                                             get_deployment_fingerprint, deploy_arm_template_if_changed)
+
+TEMPLATE = {'parameters': {'name': {'type': 'string'}, 'adminPassword': {'type': 'securestring'}}}
+
+
+def ip_rule(name, *conditions, priority=8):
+    return SimpleNamespace(name=name, priority=priority, match_conditions=[
+        SimpleNamespace(operator='IPMatch', match_values=list(values)) for values in conditions])
+
+
+def waf_policy(*rules):
+    return SimpleNamespace(name='waf', location='East US', etag='"1"', custom_rules=list(rules))
+
+
+def http_error(status_code, retry_after=None):
+    # built without __init__, which parses the body of a real response
+    err = HttpResponseError.__new__(HttpResponseError)
+    err.status_code = status_code
+    err.response = SimpleNamespace(status_code=status_code, headers={'Retry-After': retry_after} if retry_after else {})
+    return err
+
+
+def operation(operation_id, state):
+    return SimpleNamespace(operation_id=operation_id, properties=SimpleNamespace(
+        provisioning_state=state, duration='PT10S', target_resource=SimpleNamespace(
+            resource_type='Microsoft.Network/virtualNetworks', resource_name=f'vnet{operation_id}')))
+
+
+def deployment(state):
+    return SimpleNamespace(properties=SimpleNamespace(provisioning_state=state, error=None))
+
+
+def models(*names, **_):
+    # the sdk models are only constructed with keyword arguments
+    return [SimpleNamespace for _ in names]
+
+
+class IpRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cmd = SimpleNamespace(get_models=models)
+
+    def test_pack_match_values(self):
+        values = [f'10.0.{i // 256}.{i % 256}/32' for i in range(600)]
+        conditions = pack_match_values(values)
+        self.assertEqual([len(c) for c in conditions], [540, 60])
+        self.assertEqual([v for c in conditions for v in c], values)
+        self.assertEqual(pack_match_values(values[:10], per_condition=4), [values[:4], values[4:8], values[8:10]])
+
+    def test_pack_match_values_over_rule_limit(self):
+        with self.assertRaisesRegex(CLIError, 'AllowKnownIPs'):
+            pack_match_values([f'10.0.{i // 256}.{i % 256}/32' for i in range(601)], GATEWAY_WAF_RULE_NAME)
+
+    def test_set_ip_rules(self):
+        other = SimpleNamespace(name='BlockUnknownUris', priority=5, match_conditions=[])
+        policy = waf_policy(other)
+        values = [f'10.0.{i // 256}.{i % 256}/32' for i in range(550)]
+        rule = set_ip_rules(self.cmd, policy, GATEWAY_WAF_RULE_NAME, values, 8)
+
+        self.assertEqual(policy.custom_rules, [other, rule])
+        # a single block rule, an address is only blocked if it's in none of the negated conditions
+        self.assertEqual((rule.name, rule.priority, rule.action), (GATEWAY_WAF_RULE_NAME, 8, 'Block'))
+        self.assertEqual([len(c.match_values) for c in rule.match_conditions], [540, 10])
+        self.assertTrue(all(c.negation_conditon and c.operator == 'IPMatch' for c in rule.match_conditions))
+
+    def test_set_ip_rules_replaces_legacy_rules(self):
+        # earlier versions wrote the values that didn't fit into numbered allow rules
+        policy = waf_policy(ip_rule(GATEWAY_WAF_RULE_NAME, ['10.0.0.0/24']),
+                            ip_rule(f'{GATEWAY_WAF_RULE_NAME}-1', ['10.0.1.0/24'], priority=9),
+                            ip_rule(f'{GATEWAY_WAF_RULE_NAME}-Other', ['10.0.2.0/24'], priority=20))
+        self.assertEqual(get_ip_rule_values(policy, GATEWAY_WAF_RULE_NAME), ['10.0.0.0/24', '10.0.1.0/24'])
+
+        set_ip_rules(self.cmd, policy, GATEWAY_WAF_RULE_NAME, ['10.0.0.0/23'], 8)
+        self.assertEqual([r.name for r in policy.custom_rules],
+                         [f'{GATEWAY_WAF_RULE_NAME}-Other', GATEWAY_WAF_RULE_NAME])
+        self.assertEqual(get_ip_rule_values(policy, GATEWAY_WAF_RULE_NAME), ['10.0.0.0/23'])
+
+    def test_set_ip_rules_custom_rule_limit(self):
+        policy = waf_policy(*[SimpleNamespace(name=f'rule{i}', priority=i) for i in range(100)])
+        with self.assertRaises(CLIError):
+            set_ip_rules(self.cmd, policy, GATEWAY_WAF_RULE_NAME, ['10.0.0.0/24'], 8)
+
+
+class UpdateIpRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cmd = SimpleNamespace(get_models=models)
+        self.client = mock.MagicMock()
+
+    def test_diff_ip_values(self):
+        # addresses are compared, not strings
+        self.assertEqual(diff_ip_values(['10.0.0.0/25', '10.0.0.128/25'], ['10.0.0.0/24']), ([], []))
+        self.assertEqual(diff_ip_values(['10.0.0.0/24'], ['10.0.0.0/23', '203.0.113.5']),
+                         (['10.0.1.0/24', '203.0.113.5/32'], []))
+        self.assertEqual(diff_ip_values(['10.0.0.0/24', '2001:db8::/64'], ['10.0.0.0/25']),
+                         ([], ['10.0.0.128/25', '2001:db8::/64']))
+
+    def test_unchanged_skips_put(self):
+        policy = waf_policy(ip_rule(GATEWAY_WAF_RULE_NAME, ['10.0.0.0/25', '10.0.0.128/25']))
+        result = update_ip_rules(self.cmd, self.client, 'rg', policy, GATEWAY_WAF_RULE_NAME, ['10.0.0.0/24'], 8)
+        self.assertEqual(result, {'updated': False, 'added': [], 'removed': []})
+        self.client.create_or_update.assert_not_called()
+
+    def test_changed_puts_with_etag(self):
+        policy = waf_policy(ip_rule(GATEWAY_WAF_RULE_NAME, ['10.0.0.0/24']))
+        result = update_ip_rules(self.cmd, self.client, 'rg', policy, GATEWAY_WAF_RULE_NAME, ['10.0.0.0/23'], 8)
+        self.assertEqual(result, {'updated': True, 'added': ['10.0.1.0/24'], 'removed': []})
+        self.client.create_or_update.assert_called_once_with('rg', 'waf', policy, headers={'If-Match': '"1"'})
+
+    def test_legacy_rules_rewritten(self):
+        policy = waf_policy(ip_rule(GATEWAY_WAF_RULE_NAME, ['10.0.0.0/24']),
+                            ip_rule(f'{GATEWAY_WAF_RULE_NAME}-1', ['10.0.1.0/24'], priority=9))
+        result = update_ip_rules(self.cmd, self.client, 'rg', policy, GATEWAY_WAF_RULE_NAME, ['10.0.0.0/23'], 8)
+        self.assertTrue(result['updated'])
+        self.assertEqual([r.name for r in policy.custom_rules], [GATEWAY_WAF_RULE_NAME])
+        self.client.create_or_update.assert_called_once()
+
+
+class DeploymentFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tags = {}
+        self.deployments = {}
+        patches = [
+            mock.patch.object(_deploy_utils, 'get_resource_group_tags', side_effect=lambda *_: dict(self.tags)),
+            mock.patch.object(_deploy_utils, 'tag_resource_group', side_effect=lambda c, r, t: self.tags.update(t)),
+            mock.patch.object(_deploy_utils, 'get_succeeded_deployment',
+                              side_effect=lambda c, r, name: self.deployments.get(name)),
+            mock.patch.object(_deploy_utils, 'deploy_arm_template_at_resource_group', side_effect=self._deploy)
+        ]
+        self.deploy = patches[-1].start()
+        for patch in patches[:-1]:
+            patch.start()
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def _deploy(self, *_, **__):
+        name = f'deployA{len(self.deployments)}'
+        deployment = SimpleNamespace(name=name, properties=SimpleNamespace(outputs={'n': len(self.deployments)}))
+        self.deployments[name] = deployment
+        return deployment, deployment.properties.outputs
+
+    def _deploy_if_changed(self, password='Secure1!', force=False, extra=None):
+        params = [['name=gateway', f'adminPassword={password}']]
+        return deploy_arm_template_if_changed(None, 'rg', 'deployA', TEMPLATE, params, extra=extra, force=force)
+
+    def test_fingerprint(self):
+        params = [['name=gateway'], ['adminPassword=Secure1!']]
+        fingerprint = get_deployment_fingerprint(TEMPLATE, params, {'gateway.zip': '0'})
+        # parameter order doesn't matter, the template, values and extra inputs do
+        self.assertEqual(fingerprint, get_deployment_fingerprint(TEMPLATE, params[::-1], {'gateway.zip': '0'}))
+        self.assertNotEqual(fingerprint, get_deployment_fingerprint(TEMPLATE, params, {'gateway.zip': '1'}))
+        self.assertNotEqual(fingerprint, get_deployment_fingerprint({}, params, {'gateway.zip': '0'}))
+        self.assertNotEqual(fingerprint, get_deployment_fingerprint(
+            TEMPLATE, [['name=gateway'], ['adminPassword=Secure2!']], {'gateway.zip': '0'}))
+
+    def test_secrets_hashed(self):
+        with mock.patch.object(_deploy_utils.json, 'dumps', wraps=json.dumps) as dumps:
+            get_deployment_fingerprint(TEMPLATE, [['name=gateway', 'adminPassword=Secure1!', 'authToken=abc']])
+        hashed = dumps.call_args[0][0]['parameters']
+        self.assertEqual(hashed['name'], 'gateway')
+        self.assertNotIn('Secure1!', json.dumps(hashed))
+        self.assertNotIn('abc', hashed.values())
+
+    def test_unchanged_deployment_skipped(self):
+        _, outputs = self._deploy_if_changed()
+        self.assertEqual(self.tags[tag_key('deployA')].split(':')[0], 'deployA0')
+
+        self.assertEqual(self._deploy_if_changed(), (self.deployments['deployA0'], outputs))
+        self.assertEqual(self.deploy.call_count, 1)
+
+    def test_changed_or_forced_deployment_runs(self):
+        self._deploy_if_changed()
+        self._deploy_if_changed(password='Secure2!')
+        self._deploy_if_changed(password='Secure2!', force=True)
+        self.assertEqual(self.deploy.call_count, 3)
+        self.assertEqual(self.tags[tag_key('deployA')].split(':')[0], 'deployA2')
+
+    def test_missing_deployment_runs(self):
+        self._deploy_if_changed()
+        # the recorded deployment was deleted or didn't succeed
+        self.deployments.clear()
+        self._deploy_if_changed()
+        self.assertEqual(self.deploy.call_count, 2)
+
+    def test_bad_parameters_fail_first(self):
+        with self.assertRaises(InvalidTemplateError):
+            deploy_arm_template_if_changed(None, 'rg', 'deployA', TEMPLATE, [['name=gateway']])
+        self.deploy.assert_not_called()
+
+
+class ResourceGroupLocationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tags = {tag_key('locations'): '["eastus"]'}
+        patches = [
+            mock.patch.object(_deploy_utils, 'get_resource_group_tags', side_effect=lambda *_: dict(self.tags)),
+            mock.patch.object(_deploy_utils, 'tag_resource_group', side_effect=lambda c, r, t: self.tags.update(t))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_add_location(self):
+        self.assertEqual(add_resource_group_locations(None, 'rg', ['westus']), ['eastus', 'westus'])
+        self.assertEqual(self.tags[tag_key('location:westus')], 'westus')
+
+    def test_tag_limit(self):
+        self.tags.update({f'tag{i}': '' for i in range(RESOURCE_GROUP_MAX_TAGS - len(self.tags))})
+        with self.assertRaises(CLIError):
+            add_resource_group_locations(None, 'rg', ['westus'])
+        self.assertNotIn(tag_key('location:westus'), self.tags)
+
+    def test_existing_location_at_limit(self):
+        self.tags[tag_key('location:westus')] = 'westus'
+        self.tags.update({f'tag{i}': '' for i in range(RESOURCE_GROUP_MAX_TAGS - len(self.tags))})
+        self.assertEqual(add_resource_group_locations(None, 'rg', ['westus']), ['eastus', 'westus'])
+
+
+class RemoveIpsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cmd = SimpleNamespace(cli_ctx=None, get_models=models)
+        self.policy = waf_policy(ip_rule(GATEWAY_WAF_RULE_NAME, ['10.0.0.0/24', '203.0.113.5/32']))
+        self.client = mock.MagicMock()
+        self.client.web_application_firewall_policies.get.return_value = self.policy
+        patch = mock.patch.object(_deploy_utils, 'network_client_factory', return_value=self.client)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_remove_part_of_range(self):
+        result = remove_ips_gateway_waf_policy(self.cmd, 'lgw', 'rg', ['10.0.0.128/25', '203.0.113.5'])
+        self.assertEqual(result['ips'], ['10.0.0.0/25'])
+        self.assertEqual(result['removed'], ['10.0.0.128/25', '203.0.113.5/32'])
+        self.assertEqual(get_ip_rule_values(self.policy, GATEWAY_WAF_RULE_NAME), ['10.0.0.0/25'])
+        self.client.web_application_firewall_policies.create_or_update.assert_called_once()
+
+    def test_remove_everything(self):
+        with self.assertRaises(CLIError):
+            remove_ips_gateway_waf_policy(self.cmd, 'lgw', 'rg', ['10.0.0.0/8', '203.0.113.0/24'])
+        self.client.web_application_firewall_policies.create_or_update.assert_not_called()
+        self.assertEqual(get_ip_rule_values(self.policy, GATEWAY_WAF_RULE_NAME), ['10.0.0.0/24', '203.0.113.5/32'])
+
+
+class WatchDeploymentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.sleeps = []
+        patches = [
+            mock.patch.object(_deploy_utils, 'resource_client_factory', return_value=self.client),
+            mock.patch.object(_deploy_utils, 'sleep', side_effect=self.sleeps.append),
+            mock.patch.object(_deploy_utils, 'monotonic', side_effect=lambda: sum(self.sleeps))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.cmd = SimpleNamespace(cli_ctx=None)
+
+    def test_succeeded(self):
+        self.client.deployment_operations.list.side_effect = [
+            [operation(1, 'Running')],
+            [operation(1, 'Succeeded'), operation(2, 'Running')],
+            [operation(1, 'Succeeded'), operation(2, 'Succeeded')]
+        ]
+        self.client.deployments.get.side_effect = [deployment('Succeeded')]
+        messages = []
+        result = watch_deployment(self.cmd, 'rg', 'deployA', progress=messages.append)
+        self.assertEqual(result.properties.provisioning_state, 'Succeeded')
+        # the deployment is only read once its operations stopped running
+        self.assertEqual(self.client.deployments.get.call_count, 1)
+        self.assertEqual(messages[-1], 'virtualNetworks vnet2: Succeeded (10s)')
+        self.assertTrue(all(s >= _deploy_utils.OPERATIONS_POLL_INTERVAL_MIN for s in self.sleeps))
+
+    def test_failed(self):
+        self.client.deployment_operations.list.return_value = [operation(1, 'Failed')]
+        self.client.deployments.get.return_value = deployment('Failed')
+        with self.assertRaises(DeploymentFailedError):
+            watch_deployment(self.cmd, 'rg', 'deployA')
+
+    def test_idle_polls_back_off(self):
+        self.client.deployment_operations.list.return_value = [operation(1, 'Running')]
+        self.client.deployments.get.side_effect = [deployment('Running')] * 5 + [deployment('Succeeded')]
+        watch_deployment(self.cmd, 'rg', 'deployA')
+        self.assertEqual(self.sleeps[-1], _deploy_utils.OPERATIONS_POLL_INTERVAL_MAX)
+
+    def test_retry_after_zero_is_clamped(self):
+        self.client.deployment_operations.list.side_effect = [http_error(429, '0'), []]
+        self.client.deployments.get.return_value = deployment('Succeeded')
+        watch_deployment(self.cmd, 'rg', 'deployA')
+        self.assertEqual(self.sleeps, [_deploy_utils.OPERATIONS_POLL_INTERVAL_MIN] * 2)
+
+    def test_persistent_throttling_stops(self):
+        self.client.deployment_operations.list.side_effect = http_error(429)
+        with self.assertRaises(HttpResponseError):
+            watch_deployment(self.cmd, 'rg', 'deployA')
+        self.assertEqual(len(self.sleeps), _deploy_utils.OPERATIONS_POLL_MAX_FAILURES)
+
+    def test_deadline(self):
+        self.client.deployment_operations.list.return_value = [operation(1, 'Running')]
+        self.client.deployments.get.return_value = deployment('Running')
+        with self.assertRaises(_deploy_utils.AzureResponseError):
+            watch_deployment(self.cmd, 'rg', 'deployA', deadline=600)
+        self.assertLessEqual(sum(self.sleeps), 600)
+
+    def test_other_errors_raise(self):
+        self.client.deployment_operations.list.side_effect = http_error(403)
+        with self.assertRaises(HttpResponseError):
+            watch_deployment(self.cmd, 'rg', 'deployA')
+        self.assertEqual(len(self.sleeps), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from azext_lab_gateway import _http_utils
+from azext_lab_gateway._http_utils import (retry_call, get_retry_after, get_backoff, CircuitOpenError)
+
+
+class TransientError(Exception):
+
+    def __init__(self, retry_after=None):
+        super().__init__('transient')
+        self.response = SimpleNamespace(headers={'Retry-After': retry_after} if retry_after else {})
+
+
+def is_transient(err):
+    return isinstance(err, TransientError)
+
+
+class RetryCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.sleeps = []
+        patches = [
+            mock.patch.object(_http_utils, '_breakers', {}),
+            mock.patch.object(_http_utils, 'sleep', side_effect=self._sleep),
+            mock.patch.object(_http_utils, 'monotonic', side_effect=lambda: self.now),
+            # the largest backoff allowed, without jitter
+            mock.patch.object(_http_utils.random, 'uniform', side_effect=lambda low, high: high)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def _func(self, *results):
+        results = list(results)
+
+        def _call():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return mock.Mock(side_effect=_call)
+
+    def test_retries_with_backoff(self):
+        func = self._func(TransientError(), TransientError(), TransientError(), 'ok')
+        self.assertEqual(retry_call(func, is_transient), 'ok')
+        self.assertEqual(self.sleeps, [0.5, 1, 2])
+
+    def test_backoff_is_capped(self):
+        self.assertEqual(get_backoff(10), _http_utils.BACKOFF_MAX)
+
+    def test_retry_after(self):
+        func = self._func(TransientError(retry_after='7'), 'ok')
+        self.assertEqual(retry_call(func, is_transient), 'ok')
+        self.assertEqual(self.sleeps, [7])
+        self.assertEqual(get_retry_after(SimpleNamespace(headers={'Retry-After': '-1'})), 0)
+        self.assertIsNone(get_retry_after(SimpleNamespace(headers={'Retry-After': 'soon'})))
+
+    def test_other_errors_not_retried(self):
+        func = self._func(ValueError('bad'), 'ok')
+        with self.assertRaises(ValueError):
+            retry_call(func, is_transient)
+        self.assertEqual(func.call_count, 1)
+
+    def test_tries_exhausted(self):
+        func = self._func(*[TransientError()] * 3)
+        with self.assertRaises(TransientError):
+            retry_call(func, is_transient, tries=3)
+        self.assertEqual(func.call_count, 3)
+
+    def test_deadline(self):
+        func = self._func(*[TransientError(retry_after='60')] * 5)
+        with self.assertRaises(TransientError):
+            retry_call(func, is_transient, deadline=100)
+        # a wait that would go past the deadline isn't started
+        self.assertEqual(self.sleeps, [60])
+
+    def test_circuit_opens_and_closes(self):
+        host = 'github.com'
+        for _ in range(_http_utils.BREAKER_THRESHOLD):
+            with self.assertRaises(TransientError):
+                retry_call(self._func(TransientError()), is_transient, host=host, tries=1)
+
+        func = self._func('ok')
+        with self.assertRaises(CircuitOpenError):
+            retry_call(func, is_transient, host=host)
+        func.assert_not_called()
+        # other hosts aren't affected
+        self.assertEqual(retry_call(self._func('ok'), is_transient, host='api.github.com'), 'ok')
+
+        self.now += _http_utils.BREAKER_COOLDOWN
+        self.assertEqual(retry_call(func, is_transient, host=host), 'ok')
+        self.assertNotIn(host, _http_utils._breakers)
+
+    def test_non_transient_errors_dont_open_circuit(self):
+        for _ in range(_http_utils.BREAKER_THRESHOLD):
+            with self.assertRaises(ValueError):
+                retry_call(self._func(ValueError('bad')), is_transient, host='github.com')
+        self.assertEqual(retry_call(self._func('ok'), is_transient, host='github.com'), 'ok')
+
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.MagicMock()
+        patches = [
+            mock.patch.object(_http_utils, '_breakers', {}),
+            mock.patch.object(_http_utils, 'sleep'),
+            mock.patch.object(_http_utils, 'get_session', return_value=self.session)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_transient_status_retried(self):
+        responses = [SimpleNamespace(status_code=503, headers={}, close=mock.Mock()),
+                     SimpleNamespace(status_code=200, headers={})]
+        self.session.request.side_effect = responses
+        self.assertIs(_http_utils.get('https://github.com/index.json'), responses[1])
+        responses[0].close.assert_called_once()
+
+    def test_last_response_returned(self):
+        response = SimpleNamespace(status_code=429, headers={}, close=mock.Mock())
+        self.session.request.return_value = response
+        self.assertIs(_http_utils.get('https://github.com/index.json', tries=2), response)
+        self.assertEqual(self.session.request.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
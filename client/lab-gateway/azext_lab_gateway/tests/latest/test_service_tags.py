@@ -0,0 +1,117 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import random
+import ipaddress
+import tempfile
+import unittest
+from time import perf_counter
+from types import SimpleNamespace
+from unittest import mock
+
+from azext_lab_gateway import _deploy_utils
+from azext_lab_gateway._constants import SERVICE_TAGS_ALL
+from azext_lab_gateway._deploy_utils import (get_azure_rp_ips, aggregate_azure_rp_ips, pack_match_values)
+
+# the AzureCloud tag list has ~150 tags and ~20k prefixes in total
+REGION_COUNT = 150
+BLOCKS_PER_REGION = 4
+
+
+def tile(rng, network, max_depth):
+    """ Splits the network into random sized subnets that exactly cover it. """
+    if max_depth == 0 or rng.random() < 0.2:
+        return [network]
+    return [p for half in network.subnets() for p in tile(rng, half, max_depth - 1)]
+
+
+def service_tags_snapshot(seed=0):
+    """ A synthetic AzureCloud service tag list. Each regional tag covers a few blocks, split into many
+    small prefixes, and the global AzureCloud tag repeats every regional prefix. Returns the tags and
+    the blocks each regional tag aggregates to. """
+    rng = random.Random(seed)
+    regions = sorted(set(SERVICE_TAGS_ALL)) + [f'AzureCloud.region{i}' for i in range(REGION_COUNT)]
+    tags, blocks = {}, {}
+    for i, tag in enumerate(regions[:REGION_COUNT]):
+        region_blocks = [ipaddress.ip_network((0x14000000 + (i * BLOCKS_PER_REGION + b) * 0x10000, 16))
+                         for b in range(BLOCKS_PER_REGION)]
+        region_blocks.append(ipaddress.ip_network(f'2603:{0x1000 + i:x}::/40'))
+        prefixes = [p for block in region_blocks for p in tile(rng, block, 7)]
+        rng.shuffle(prefixes)
+        tags[tag] = [str(p) for p in prefixes]
+        blocks[tag] = region_blocks
+    tags['AzureCloud'] = [p for prefixes in tags.values() for p in prefixes]
+    return tags, blocks
+
+
+def collapse(networks):
+    """ ipaddress.collapse_addresses, for lists with both address families. """
+    networks = list(networks)
+    return [str(n) for version in (4, 6)
+            for n in ipaddress.collapse_addresses(n for n in networks if n.version == version)]
+
+
+def service_tags_response(tags):
+    values = [SimpleNamespace(id=k, properties=SimpleNamespace(address_prefixes=v)) for k, v in tags.items()]
+    return SimpleNamespace(change_number='1', values=values)
+
+
+class ServiceTagsBenchmarkTest(unittest.TestCase):
+    """ Aggregates a full size AzureCloud service tag list. The timings are printed for comparison (pytest -s). """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tags, cls.blocks = service_tags_snapshot()
+
+    def setUp(self):
+        self.cmd = SimpleNamespace(cli_ctx=SimpleNamespace(cloud=SimpleNamespace(name='AzureCloud')))
+        self.client = mock.MagicMock()
+        self.client.service_tags.list.return_value = service_tags_response(self.tags)
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patches = [
+            mock.patch.object(_deploy_utils, '_service_tags', {}),
+            mock.patch.object(_deploy_utils, 'network_client_factory', return_value=self.client),
+            mock.patch.object(_deploy_utils, 'get_cache_dir', lambda *p: '/'.join((cache_dir.name,) + p[1:]))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _time(self, name, func):
+        start = perf_counter()
+        result = func()
+        print(f'{name}: {(perf_counter() - start) * 1000:.1f} ms')
+        return result
+
+    def test_benchmark_all_regions(self):
+        snapshot = self._time('get_service_tag_snapshot',
+                              lambda: _deploy_utils.get_service_tag_snapshot(self.cmd, 'eastus'))
+        self.assertNotIn('AzureCloud', snapshot)
+        ips = list(snapshot.values())
+        self.assertGreater(sum(len(i) for i in ips), 20000)
+
+        result = self._time('aggregate_azure_rp_ips', lambda: aggregate_azure_rp_ips(ips))
+        networks = [ipaddress.ip_network(p) for tag_ips in ips for p in tag_ips]
+        expected = self._time('ipaddress.collapse_addresses', lambda: collapse(networks))
+        self.assertEqual(result, expected)
+
+    def test_region_fits_one_rule(self):
+        ips = get_azure_rp_ips(self.cmd, 'eastus', ['eastus', 'westeurope', 'westcentralus'])
+        self.assertTrue(ips)
+
+        result = aggregate_azure_rp_ips(ips)
+        tags = [t for t in set(SERVICE_TAGS_ALL) if self.tags[t] in ips]
+        self.assertEqual(result, collapse(b for t in tags for b in self.blocks[t]))
+        self.assertEqual(pack_match_values(result), [result])
+
+    def test_snapshot_fetched_once(self):
+        for _ in range(3):
+            get_azure_rp_ips(self.cmd, 'eastus', ['eastus'])
+        self.client.service_tags.list.assert_called_once_with('eastus')
+
+
+if __name__ == '__main__':
+    unittest.main()
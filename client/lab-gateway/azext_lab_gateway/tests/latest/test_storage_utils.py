@@ -0,0 +1,40 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import unittest
+from unittest import mock
+
+from azext_lab_gateway import _storage_utils
+from azext_lab_gateway._http_utils import CircuitOpenError
+from azext_lab_gateway._storage_utils import copy_blob_from_url
+
+URL = 'https://github.com/colbylwilliams/lab-gateway/releases/download/v1.0.0/gateway.zip'
+
+
+class CopyBlobFromUrlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blob_client = mock.MagicMock(blob_name='gateway.zip')
+        patch = mock.patch.object(_storage_utils, 'stream_blob_from_url')
+        self.stream = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_server_side_copy(self):
+        self.blob_client.get_blob_properties.return_value.copy.status = 'success'
+        with mock.patch.object(_storage_utils, 'http_head') as head:
+            head.return_value.url = 'https://objects.githubusercontent.com/gateway.zip?sig=1'
+            copy_blob_from_url(self.blob_client, URL)
+        self.blob_client.start_copy_from_url.assert_called_once_with(head.return_value.url, metadata=None)
+        self.stream.assert_not_called()
+
+    def test_open_circuit_falls_back_to_streaming(self):
+        with mock.patch.object(_storage_utils, 'http_head', side_effect=CircuitOpenError('open')):
+            copy_blob_from_url(self.blob_client, URL, metadata={'sha256': '0'})
+        self.blob_client.start_copy_from_url.assert_not_called()
+        self.stream.assert_called_once_with(self.blob_client, URL, metadata={'sha256': '0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
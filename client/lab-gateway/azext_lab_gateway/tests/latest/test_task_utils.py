@@ -0,0 +1,144 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from knack.util import CLIError
+
+from azext_lab_gateway import _cache_utils
+from azext_lab_gateway._task_utils import (TaskGraph, StepJournal, StaleStepError)
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def _step(self, name, result=None):
+        def _run(*args):
+            with self.lock:
+                self.events.append(name)
+            return result if result is not None else (name, args)
+        return _run
+
+    def test_requires_run_first(self):
+        graph = TaskGraph()
+        graph.add('a', self._step('a', 1))
+        graph.add('b', self._step('b', 2))
+        graph.add('c', self._step('c'), requires=['b', 'a'])
+        graph.add('d', self._step('d'), requires=['c'])
+        results = graph.run()
+
+        # a step gets the results of its required steps in the order they were listed
+        self.assertEqual(results['c'], ('c', (2, 1)))
+        self.assertEqual(results['d'], ('d', (('c', (2, 1)),)))
+        self.assertLess(self.events.index('a'), self.events.index('c'))
+        self.assertLess(self.events.index('b'), self.events.index('c'))
+        self.assertEqual(self.events[-1], 'd')
+
+    def test_independent_steps_run_concurrently(self):
+        # neither step can finish unless both are running at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        graph = TaskGraph(max_workers=2)
+        graph.add('a', barrier.wait)
+        graph.add('b', barrier.wait)
+        graph.run()
+
+    def test_failure_stops_dependents(self):
+        def _fail():
+            raise CLIError('failed')
+
+        graph = TaskGraph()
+        graph.add('a', _fail)
+        graph.add('b', self._step('b'), requires=['a'])
+        with self.assertRaisesRegex(CLIError, 'failed'):
+            graph.run()
+        self.assertEqual(self.events, [])
+
+    def test_unknown_and_duplicate_steps(self):
+        graph = TaskGraph()
+        graph.add('a', self._step('a'))
+        with self.assertRaises(CLIError):
+            graph.add('a', self._step('a'))
+        # steps can only require steps added before them, so cycles can't be built
+        with self.assertRaises(CLIError):
+            graph.add('b', self._step('b'), requires=['c'])
+
+    def test_progress_reported_from_run_thread(self):
+        hook = mock.MagicMock()
+        threads = []
+        hook.add.side_effect = lambda **_: threads.append(threading.current_thread())
+        graph = TaskGraph(hook=hook)
+        graph.add('a', lambda: graph.report('working on a'), message='Starting a')
+        graph.run()
+
+        self.assertEqual([c.kwargs['message'] for c in hook.add.call_args_list], ['Starting a', 'working on a'])
+        self.assertEqual(set(threads), {threading.current_thread()})
+
+
+class StepJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        patch = mock.patch.object(_cache_utils, 'get_config_dir', return_value=config_dir.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.calls = []
+
+    def _graph(self, journal, stale=False):
+        def _load(record):
+            if stale:
+                raise StaleStepError('resource no longer exists')
+            return tuple(record)
+
+        graph = TaskGraph(journal=journal)
+        graph.add('a', lambda: self.calls.append('a') or ('a', 1), save=list, load=_load)
+        graph.add('b', lambda a: self.calls.append('b') or a[1] + 1, requires=['a'])
+        return graph
+
+    def test_record_and_load(self):
+        journal = StepJournal('sub', 'RG', 'v1.0.0')
+        journal.record('a', {'id': 1})
+        # resource group names are case insensitive, so journal keys are too
+        self.assertEqual(StepJournal('sub', 'rg', 'v1.0.0').load().get('a'), {'id': 1})
+        self.assertIsNone(StepJournal('sub', 'rg', 'v1.1.0').load().get('a'))
+
+        journal.clear()
+        self.assertIsNone(StepJournal('sub', 'rg', 'v1.0.0').load().get('a'))
+
+    def test_resume_skips_completed_steps(self):
+        self.assertEqual(self._graph(StepJournal('sub', 'rg').load()).run()['b'], 2)
+        self.assertEqual(self.calls, ['a', 'b'])
+
+        # steps without a load function always run
+        self.calls.clear()
+        results = self._graph(StepJournal('sub', 'rg').load()).run()
+        self.assertEqual(results['a'], ('a', 1))
+        self.assertEqual(self.calls, ['b'])
+
+    def test_stale_step_reruns(self):
+        self._graph(StepJournal('sub', 'rg').load()).run()
+        self.calls.clear()
+        self._graph(StepJournal('sub', 'rg').load(), stale=True).run()
+        self.assertEqual(self.calls, ['a', 'b'])
+
+    def test_failed_step_not_recorded(self):
+        def _fail():
+            raise CLIError('failed')
+
+        graph = TaskGraph(journal=StepJournal('sub', 'rg').load())
+        graph.add('a', _fail, load=lambda r: r)
+        with self.assertRaises(CLIError):
+            graph.run()
+        self.assertIsNone(StepJournal('sub', 'rg').load().get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import json
+import hashlib
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from azure.cli.core.azclierror import (ClientRequestError, InvalidTemplateError)
+
+from azext_lab_gateway import _cache_utils, _template_utils
+from azext_lab_gateway._template_utils import (get_template, get_template_parameters)
+
+TEMPLATE = {
+    'parameters': {
+        'name': {'type': 'string'},
+        'instanceCount': {'type': 'int', 'defaultValue': 1},
+        'enabled': {'type': 'bool', 'defaultValue': True},
+        'tags': {'type': 'object', 'defaultValue': {}},
+        'ips': {'type': 'array', 'defaultValue': []},
+        'sku': {'type': 'string', 'defaultValue': 'Standard', 'allowedValues': ['Standard', 'Premium']},
+        'adminPassword': {'type': 'securestring', 'defaultValue': ''}
+    }
+}
+
+
+class TemplateParametersTest(unittest.TestCase):
+
+    def test_typed_values(self):
+        params = get_template_parameters(TEMPLATE, [['name=gateway', 'instanceCount=3'],
+                                                    ['ENABLED=false', 'tags={"a": "b"}', 'ips=["10.0.0.0/24"]']])
+        self.assertEqual(params, {
+            'name': {'value': 'gateway'},
+            'instanceCount': {'value': 3},
+            'enabled': {'value': False},
+            'tags': {'value': {'a': 'b'}},
+            'ips': {'value': ['10.0.0.0/24']}
+        })
+
+    def test_values_keep_equals_signs(self):
+        params = get_template_parameters(TEMPLATE, [['name=gateway', 'adminPassword=a=b']])
+        self.assertEqual(params['adminPassword'], {'value': 'a=b'})
+
+    def test_unknown_parameter(self):
+        with self.assertRaisesRegex(InvalidTemplateError, "did you mean 'instanceCount'"):
+            get_template_parameters(TEMPLATE, [['name=gateway', 'instanceCont=3']])
+
+    def test_missing_parameter(self):
+        with self.assertRaisesRegex(InvalidTemplateError, 'missing values for parameters: name'):
+            get_template_parameters(TEMPLATE, [['instanceCount=3']])
+
+    def test_not_key_value(self):
+        with self.assertRaises(InvalidTemplateError):
+            get_template_parameters(TEMPLATE, [['name']])
+
+    def test_wrong_types(self):
+        for param in ['instanceCount=three', 'enabled=yes', 'tags=[]', 'ips={}', 'ips=nope', 'sku=Basic']:
+            with self.assertRaises(InvalidTemplateError, msg=param):
+                get_template_parameters(TEMPLATE, [['name=gateway', param]])
+
+    def test_secret_not_in_error(self):
+        schema = {'parameters': {'adminPassword': {'type': 'int'}}}
+        with self.assertRaises(InvalidTemplateError) as context:
+            get_template_parameters(schema, [['adminPassword=Secure1!']])
+        self.assertNotIn('Secure1!', str(context.exception))
+
+
+class GetTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        self.content = json.dumps(TEMPLATE).encode('utf-8')
+        self.download = mock.Mock(side_effect=lambda url: SimpleNamespace(status_code=200, content=self.content))
+        patches = [
+            mock.patch.object(_cache_utils, 'get_config_dir', return_value=config_dir.name),
+            mock.patch.object(_template_utils, 'http_get', self.download),
+            mock.patch.object(_template_utils, '_templates', {})
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _arm_templates(self, sha256=None, version='v1.0.0'):
+        entry = {'name': 'deployA.json', 'url': 'https://example.com/deployA.json', 'version': version}
+        if sha256:
+            entry['sha256'] = sha256
+        return {'deployA': entry}
+
+    def test_downloaded_once(self):
+        arm_templates = self._arm_templates(hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(get_template(arm_templates, 'deployA'), TEMPLATE)
+        # a new process only has the on-disk cache
+        _template_utils._templates.clear()
+        self.assertEqual(get_template(arm_templates, 'deployA'), TEMPLATE)
+        self.assertEqual(self.download.call_count, 1)
+
+    def test_hash_mismatch(self):
+        with self.assertRaisesRegex(ClientRequestError, 'sha256'):
+            get_template(self._arm_templates('0' * 64), 'deployA')
+
+    def test_modified_cache_downloaded_again(self):
+        arm_templates = self._arm_templates(hashlib.sha256(self.content).hexdigest())
+        get_template(arm_templates, 'deployA')
+        path = _cache_utils.get_cache_dir(_template_utils.TEMPLATES_DIR_NAME, 'v1.0.0', 'deployA.json')
+        _cache_utils.write_file(path, b'{}')
+
+        _template_utils._templates.clear()
+        self.assertEqual(get_template(arm_templates, 'deployA'), TEMPLATE)
+        self.assertEqual(self.download.call_count, 2)
+
+    def test_unversioned_not_cached(self):
+        arm_templates = self._arm_templates(version=None)
+        get_template(arm_templates, 'deployA')
+        _template_utils._templates.clear()
+        get_template(arm_templates, 'deployA')
+        self.assertEqual(self.download.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from azext_lab_gateway import _cache_utils
+from azext_lab_gateway._validators import index_version_validator
+
+INDEX = {
+    'gateway': {'version': 'v1.2.3'},
+    'arm': {'gateway': {'url': 'https://example.com/gateway.json'}},
+    'artifacts': {}
+}
+
+
+def response(body):
+    return SimpleNamespace(status_code=200, headers={}, json=lambda: body)
+
+
+class IndexVersionValidatorTest(unittest.TestCase):
+    """ Counts the http requests made to resolve the release index, each command should only need one. """
+
+    def setUp(self):
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        patches = [
+            mock.patch.object(_cache_utils, 'get_config_dir', return_value=config_dir.name),
+            mock.patch.object(_cache_utils, 'http_get', side_effect=self._get)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.urls = []
+
+    def _get(self, url, headers=None):  # pylint: disable=unused-argument
+        self.urls.append(url)
+        if url.startswith('https://api.github.com/'):
+            return response([{'tag_name': 'v1.3.0-pre', 'prerelease': True}])
+        # a release's index names its own version
+        version = url.split('/')[-2] if '/download/v' in url else 'v1.2.3'
+        return response(dict(INDEX, gateway={'version': version}))
+
+    def _validate(self, version=None, prerelease=False, index_url=None):
+        ns = SimpleNamespace(version=version, prerelease=prerelease, index_url=index_url)
+        index_version_validator(None, ns)
+        return ns
+
+    def test_latest(self):
+        ns = self._validate()
+        self.assertEqual(len(self.urls), 1)
+        self.assertTrue(self.urls[0].endswith('/latest/download/index.json'))
+        self.assertEqual(ns.index, ('v1.2.3', INDEX['gateway'], INDEX['arm'], INDEX['artifacts']))
+        self.assertEqual(ns.version, 'v1.2.3')
+
+    def test_version(self):
+        ns = self._validate(version='1.2.3')
+        self.assertEqual(len(self.urls), 1)
+        self.assertTrue(self.urls[0].endswith('/download/v1.2.3/index.json'))
+        self.assertEqual(ns.index[0], 'v1.2.3')
+
+    def test_index_url(self):
+        ns = self._validate(index_url='https://example.com/index.json')
+        self.assertEqual(self.urls, ['https://example.com/index.json'])
+        self.assertEqual(ns.index[0], 'v1.2.3')
+
+    def test_prerelease(self):
+        # the latest pre-release has to be looked up before its index
+        ns = self._validate(prerelease=True)
+        self.assertEqual(len(self.urls), 2)
+        self.assertTrue(self.urls[1].endswith('/download/v1.3.0-pre/index.json'))
+        self.assertEqual(ns.version, 'v1.3.0-pre')
+
+    def test_released_index_is_cached(self):
+        self._validate(version='v1.2.3')
+        self._validate(version='v1.2.3')
+        self.assertEqual(len(self.urls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
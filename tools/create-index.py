@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 import argparse
 import subprocess
 from pathlib import Path
@@ -32,8 +33,11 @@ with os.scandir(Path.cwd() / arm_dir) as s:
             print(f.path)
             name = f.name.rsplit('.', 1)[0]
             assets.append({'name': f.name, 'path': f.path})
+            with open(f.path, 'rb') as a:
+                sha256 = hashlib.sha256(a.read()).hexdigest()
             index['arm'][name] = {
                 'name': f.name,
+                'sha256': sha256,
                 'version': '{}'.format(version),
                 'url': 'https://github.com/colbylwilliams/lab-gateway/releases/download/{}/{}'.format(version, f.name)
             }
@@ -44,8 +48,11 @@ with os.scandir(Path.cwd() / artifacts_dir) as s:
             print(f.path)
             name = f.name.rsplit('.', 1)[0]
             assets.append({'name': f.name, 'path': f.path})
+            with open(f.path, 'rb') as a:
+                sha256 = hashlib.sha256(a.read()).hexdigest()
             index['artifacts'][name] = {
                 'name': f.name,
+                'sha256': sha256,
                 'version': '{}'.format(version),
                 'url': 'https://github.com/colbylwilliams/lab-gateway/releases/download/{}/{}'.format(version, f.name)
             }